@@ -14,22 +14,29 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import anki.collection  # isort:skip # noqa: F401
-from anki.notes import Note
-from aqt import gui_hooks, mw
 
-from . import bidir, unidir
+import sys
+from typing import Sequence
 
+from anki import hooks
+from anki.notes import NoteId
 
-def on_editor_did_unfocus_field(changed: bool, note: Note, field_idx: int) -> bool:
-    # return True if changes were made, otherwise return changed
-    changed |= unidir.sync_field(mw.col, note, field_idx)
-    changed |= bidir.sync_field(mw.col, note, field_idx)
-    return changed
+# Running inside Anki, which imported aqt before loading add-ons. The CLI and
+# the index worker processes never import aqt, even if it is installed, so
+# they neither load Qt nor register GUI hooks.
+aqt = sys.modules.get('aqt')
+HAS_AQT = aqt is not None and aqt.mw is not None
 
 
-def on_sync_will_start():
-    unidir.sync_all(mw.col)
+def on_notes_will_be_deleted(col: anki.collection.Collection, nids: Sequence[NoteId]):
+    # Importing the index pulls in BeautifulSoup and process pools, no index
+    # was built if it is not imported yet
+    index = sys.modules.get(f'{__name__}.index')
+    if index is not None:
+        index.remove_notes(col, nids)
 
 
-gui_hooks.editor_did_unfocus_field.append(on_editor_did_unfocus_field)
-gui_hooks.sync_will_start.append(on_sync_will_start)
+# Needed wherever the collection is used
+hooks.notes_will_be_deleted.append(on_notes_will_be_deleted)
+if HAS_AQT:
+    from . import addon  # noqa: F401
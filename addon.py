@@ -0,0 +1,245 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import anki.collection
+import anki.errors
+import aqt.mediasrv
+
+from anki.collection import OpChanges
+from anki.import_export_pb2 import ImportResponse
+from anki.notes import Note
+from aqt import gui_hooks, mw
+from aqt.addons import AddonManager
+from aqt.browser import Browser
+from aqt.editor import Editor
+
+# Anki and aqt modules are loaded before add-ons, only the time spent here is measured
+_import_started = time.perf_counter()
+
+# The submodules pull in BeautifulSoup and Qt widgets and compile regexes.
+# They are imported on first use, so registering the hooks costs next to
+# nothing; the rest is loaded by preload() once Anki is idle.
+
+PRELOAD_DELAY = 1000  # ms after the profile is opened
+
+logger = AddonManager.get_logger(__name__)
+shadow_mode = False
+idle_sync = True
+presync_scope: dict = {}  # arguments of unidir.sync_all restricting the sync before an AnkiWeb sync
+
+
+def apply_config(config: dict):
+    global idle_sync, presync_scope, shadow_mode
+    from . import markup, unidir
+    try:
+        markup.set_backend(config.get('html_parser', 'html.parser'))
+    except ValueError:
+        logger.warning(f'html_parser: unknown parser {config.get("html_parser")!r}, using html.parser')
+        markup.set_backend('html.parser')
+    unidir.use_stamps = config.get('unidir_stamps', False)
+    unidir.open_store(os.path.join(os.path.dirname(__file__), 'user_files', 'render_cache.sqlite'),
+                      config.get('render_cache_size', 20000))
+    shadow_mode = config.get('shadow_mode', False)
+    idle_sync = config.get('idle_sync', True)
+    presync_scope = {
+        'search': config.get('presync_search', ''),
+        'decks': config.get('presync_decks', []),
+        'notetypes': config.get('presync_notetypes', []),
+    }
+    if not idle_sync:
+        from . import gui
+        gui.stop_idle_sync()
+
+
+def preload():
+    if mw.col is None:
+        return  # profile closed meanwhile
+    started = time.perf_counter()
+    from . import gui, unidir  # noqa: F401
+    apply_config(mw.addonManager.getConfig(__name__))
+    unidir.preload_notetypes(mw.col)
+    # Idle sync is filled from the built index, see gui.build_index
+    gui.build_index(fill=idle_sync)
+    logger.info(f'preloaded in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+
+def on_profile_did_open():
+    from . import index
+    index.opened(mw.col)
+    mw.addonManager.setConfigUpdatedAction(__name__, apply_config)
+    mw.progress.single_shot(PRELOAD_DELAY, preload)
+
+
+def on_editor_did_unfocus_field(changed: bool, note: Note, field_idx: int) -> bool:
+    from . import bidir, index, unidir
+
+    if shadow_mode and note.id != 0:
+        from . import oracle
+        oracle.compare_field(mw.col, note, field_idx, oracle.session)
+
+    fields = list(note.fields)
+    synced = unidir.sync_field(mw.col, note, field_idx)
+    synced |= bidir.sync_field(mw.col, note, field_idx)
+    if not synced:
+        return changed
+    index.invalidate(mw.col)
+
+    # Only fields whose content changed are pushed into the editor, returning
+    # True would make the editor reload the whole note
+    refreshed = [idx for idx, text in enumerate(fields) if note.fields[idx] != text]
+    if len(refreshed) == 0:
+        return changed
+    from . import gui
+    return changed if gui.refresh_fields(note, refreshed) else True
+
+
+def on_sync_will_start():
+    from . import index, unidir
+
+    try:
+        changed = unidir.sync_all(mw.col, **presync_scope)
+    except anki.errors.SearchError as e:
+        logger.warning(f'presync_search: {e}')
+        return
+    if changed > 0:
+        index.invalidate(mw.col)
+
+
+def on_operation_did_execute(changes: OpChanges, handler: object | None):
+    if changes.note_text:
+        from . import gui
+        # The step of the operation that just finished, the propagation joins it
+        gui.propagate_changes(mw.col.undo_status().last_step)
+    if changes.notetype:
+        from . import unidir
+        unidir.invalidate_notetypes(mw.col)
+
+
+def watch_imports():
+    '''
+    Sync the notes added or updated by imports. The import pages call the
+    backend through the media server, whose response carries the import log;
+    operation_did_execute only gets the changes.
+    '''
+    import_request = getattr(aqt.mediasrv, 'import_request', None)
+    if import_request is None:
+        logger.warning('imports cannot be watched, imported notes are not synced')
+        return
+
+    def on_import_request(endpoint: str) -> bytes:
+        output = import_request(endpoint)
+        response = ImportResponse()
+        response.ParseFromString(output)
+
+        def sync_imported_notes():
+            from . import batch, gui
+            gui.sync_imported_notes(batch.imported_notes(response.log))
+        mw.taskman.run_on_main(sync_imported_notes)
+        return output
+
+    aqt.mediasrv.import_request = on_import_request
+
+
+def on_sync_did_finish():
+    # Notes changed on other devices may make local blocks stale
+    if idle_sync:
+        from . import gui, index
+        if index.is_built(mw.col):
+            gui.queue_changed_notes()
+        else:
+            gui.build_index(fill=True)  # downloaded in full, any note may have changed
+
+
+def on_collection_will_temporarily_close(col: anki.collection.Collection):
+    # A full sync replaces the collection file, the index is built again from it
+    from . import index, unidir
+    index.drop(col)
+    unidir.invalidate_notetypes(col)
+
+
+def on_profile_will_close():
+    from . import index, unidir
+
+    if shadow_mode:
+        from . import oracle
+        logger.info(f'shadow mode: {oracle.session}')
+    if idle_sync:
+        from . import gui
+        gui.stop_idle_sync()
+    index.drop(mw.col)
+    unidir.invalidate_notetypes(mw.col)
+    unidir.close_store()
+
+
+def on_editor_did_init(editor: Editor):
+    from . import gui
+    gui.on_editor_did_init(editor)
+
+
+def on_editor_did_load_note(editor: Editor):
+    from . import gui
+    gui.on_editor_did_load_note(editor)
+
+
+def on_add_cards_did_add_note(note: Note):
+    from . import gui
+    gui.on_add_cards_did_add_note(note)
+
+
+def on_browser_menus_did_init(browser: Browser):
+    from . import gui
+    gui.on_browser_menus_did_init(browser)
+
+
+def watch_database_check():
+    '''
+    Check the sync index along with Check Database, which calls
+    Collection.fix_integrity in the background and reports no operation.
+    '''
+    fix_integrity = anki.collection.Collection.fix_integrity
+
+    def on_fix_integrity(col: anki.collection.Collection, *args, **kwargs):
+        result = fix_integrity(col, *args, **kwargs)
+        from . import gui, index
+        try:
+            # Still in the background, under the progress of the check
+            rebuilt = index.rebuild(col, None)
+        except Exception:
+            logger.exception('sync index could not be checked')
+            return result
+        mw.taskman.run_on_main(lambda: gui.on_index_checked(rebuilt))
+        return result
+
+    anki.collection.Collection.fix_integrity = on_fix_integrity
+
+
+gui_hooks.profile_did_open.append(on_profile_did_open)
+gui_hooks.profile_will_close.append(on_profile_will_close)
+gui_hooks.editor_did_unfocus_field.append(on_editor_did_unfocus_field)
+gui_hooks.sync_will_start.append(on_sync_will_start)
+gui_hooks.sync_did_finish.append(on_sync_did_finish)
+gui_hooks.collection_will_temporarily_close.append(on_collection_will_temporarily_close)
+gui_hooks.operation_did_execute.append(on_operation_did_execute)
+gui_hooks.editor_did_init.append(on_editor_did_init)
+gui_hooks.editor_did_load_note.append(on_editor_did_load_note)
+gui_hooks.browser_menus_did_init.append(on_browser_menus_did_init)
+gui_hooks.add_cards_did_add_note.append(on_add_cards_did_add_note)
+watch_imports()
+watch_database_check()
+
+logger.info(f'hooks registered in {(time.perf_counter() - _import_started) * 1000:.1f} ms')
@@ -0,0 +1,168 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Callable, NamedTuple, Sequence
+
+import anki.errors
+from anki.collection import Collection, OpChanges, OpChangesAfterUndo
+from anki.import_export_pb2 import ImportResponse
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
+
+from . import bidir, cas, unidir
+
+ProgressCb = Callable[[int, int], None]
+
+
+class SyncResult(NamedTuple):
+    changes: OpChanges | OpChangesAfterUndo
+    count: int  # number of updated notes
+
+
+SQL_SYNC_NOTES = 'select id from notes where id in {} and flds like \'%class="sync"%\''
+
+
+def sync_candidates(col: Collection, nids: Sequence[NoteId]) -> list[NoteId]:
+    '''
+    Return the notes containing sync spans, read in a single query.
+    '''
+    return col.db.list(SQL_SYNC_NOTES.format(ids2str(nids)))
+
+
+def imported_notes(log: ImportResponse.Log) -> list[NoteId]:
+    '''
+    Return the notes an import added or updated, see ImportLogWithChanges.
+    '''
+    return [NoteId(note.id.nid) for note in (*log.new, *log.updated)]
+
+
+def _sync(col: Collection, nids: Sequence[NoteId], resolve_cb: bidir.ResolveCb | None = None,
+          progress: ProgressCb | None = None, undo: cas.UndoStep | None = None) -> set[NoteId]:
+    # Every note is read once and updated in memory by all passes, then the
+    # changed notes are written in one batch. Sids are assigned first, so that
+    # unidir blocks rendered from other notes of the batch include them.
+    #
+    # With a resolve_cb, bidir spans are synced too. Conflicts of all the
+    # notes are resolved by a single call of resolve_cb, answers are kept when
+    # the pass is redone because notes were edited meanwhile.
+    answers: dict[str, str] = {}
+
+    def resolve_once(sids: Sequence[str]) -> dict[str, str]:
+        asked = [sid for sid in sids if sid not in answers]
+        if len(asked) > 0:
+            answers.update({sid: 'Skip' for sid in asked})
+            answers.update(resolve_cb(asked))
+        return {sid: answers[sid] for sid in sids}
+
+    updated = set()
+    for attempt in range(cas.RETRIES + 1):
+        step_progress = None if progress is None or attempt > 0 else progress
+        notes: dict[NoteId, Note] = {}
+        versions: dict[NoteId, cas.Version] = {}
+        changed: dict[NoteId, Note] = {}
+        for i, nid in enumerate(nids):
+            if step_progress is not None:
+                step_progress(i, 2 * len(nids))
+            try:
+                note = col.get_note(nid)
+            except anki.errors.NotFoundError:
+                continue  # deleted meanwhile
+            notes[nid] = note
+            versions[nid] = cas.version(note)
+            if bidir.assign_sids(col, note):
+                changed[nid] = note
+        for i, note in enumerate(notes.values()):
+            if step_progress is not None:
+                step_progress(len(nids) + i, 2 * len(nids))
+            if unidir.render_note(col, note, notes):
+                changed[note.id] = note
+        unidir.flush_store()
+
+        if resolve_cb is None:
+            # Notes edited meanwhile are updated again instead of being overwritten
+            nids = cas.write(col, list(changed.values()), versions, undo)
+            skipped = set(nids)
+            updated |= {nid for nid in changed if nid not in skipped}
+            if len(nids) == 0:
+                break
+            continue
+
+        fields = [(note, field_idx) for note in notes.values()
+                  for field_idx, text in enumerate(note.fields) if 'sync' in text]
+        try:
+            # Written together with the copies of the spans in other notes, or not at all
+            if bidir.sync_fields(col, fields, resolve_once, versions, undo, changed):
+                # The recorded versions include other notes holding copies of the spans
+                updated |= set(cas.conflicts(col, versions))
+        except cas.ConflictError:
+            continue
+        break
+    return updated
+
+
+def sync_notes(col: Collection, nids: Sequence[NoteId], label: str,
+               progress: ProgressCb | None = None, resolve_cb: bidir.ResolveCb | None = None) -> SyncResult:
+    '''
+    Assign missing sids and render unidir spans of the notes as a single undo step.
+    Notes without sync spans are skipped.
+
+    With a resolve_cb, bidir spans are synced too. It is called once with the
+    conflicting sids of all the notes.
+    '''
+    nids = sync_candidates(col, nids)
+    pos = col.add_custom_undo_entry(label)
+    updated = _sync(col, nids, resolve_cb, progress)
+    return SyncResult(col.merge_undo_entries(pos), len(updated))
+
+
+def sync_added_notes(col: Collection, added: Sequence[tuple[NoteId, int]],
+                     resolve_cb: bidir.ResolveCb = lambda _: {}) -> SyncResult:
+    '''
+    Sync notes created in the Add dialog: assign sids, render unidir spans and
+    fill bidir spans from their copies in other notes, see bidir.sync_note.
+    Conflicts are resolved by a single call of resolve_cb, by default they are
+    left for the editor.
+
+    Notes are given with the undo steps that added them. The sync of the last
+    added note is merged into its step, so undoing the addition also undoes
+    the sync. Notes added earlier are synced in a step of their own.
+    '''
+    last = col.undo_status().last_step
+    # The last step is taken first, an own step added before would bury it
+    groups = ([nid for nid, step in added if step == last], [nid for nid, step in added if step != last])
+    changes = OpChanges()
+    updated: set[NoteId] = set()
+    for nids, step in zip(groups, (last, 0)):
+        nids = sync_candidates(col, nids)
+        if len(nids) == 0:
+            continue
+        undo = cas.UndoStep(step, 'Sync added notes')
+        updated |= _sync(col, nids, resolve_cb, undo=undo)
+        if undo.target is not None:
+            changes = undo.merge(col)
+    return SyncResult(changes, len(updated))
+
+
+def update_dependents(col: Collection, dependents: Sequence[NoteId], step: int) -> SyncResult:
+    '''
+    Render unidir blocks of notes including changed notes, see SyncIndex.dependents.
+
+    The writes are merged into the undo step of the change, recorded when it
+    finished, so undoing the edit also undoes the propagation, see cas.UndoStep.
+    '''
+    undo = cas.UndoStep(step, 'Update synced notes')
+    # Dependents edited meanwhile are rendered again instead of being overwritten
+    updated = cas.update(col, dependents, unidir.render_note, undo=undo)
+    return SyncResult(undo.merge(col), len(updated))
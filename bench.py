@@ -0,0 +1,72 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Micro benchmarks of the hot paths. Run from the parent directory:
+#   python -m notesync.bench > bench_output.txt
+
+import re
+import timeit
+from typing import Callable
+
+from . import markup
+from .strip import Strip, strip
+
+FIELD = (
+    '<div class="first-upper">Some <b>bold</b> text&nbsp;and '
+    '<span class="sync" note="1702531901010">\n<div>one two</div>\n</span> more</div>\n'
+) * 50
+
+# Regex stripper used before the strip module
+RE_CLOZE = re.compile(r'{{c\d+::(.*?)(::.*?)?}}', re.DOTALL)
+
+LARGE_FIELD = '<table>' + '<tr><td>cell</td><td><b>x</b> y</td></tr>' * 5000 + '</table>' + FIELD
+
+CLOZE_FIELDS = {
+    'typical': '<div>The {{c1::mitochondria::organelle}} is the {{c2::powerhouse}} of the cell.</div>' * 20,
+    'nested': '{{c1::a {{c2::b {{c3::c}}}}}} ' * 200,
+    'unclosed': '{{c1::a::b' * 100,
+}
+
+
+def report(name: str, fn: Callable[[], object], number: int):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5))
+    print(f'{name:<40} {seconds / number * 1e6:>12.1f} us')
+
+
+def bench_parse():
+    for backend in markup.BACKENDS:
+        if markup.set_backend(backend) != backend:
+            print(f'{"parse " + backend:<40} {"n/a":>15}')
+            continue
+        report(f'parse {backend}', lambda: markup.parse(FIELD), 100)
+    markup.set_backend('html.parser')
+    report('parse + serialize', lambda: markup.serialize(markup.parse(FIELD)), 100)
+
+
+def bench_large_field():
+    report('large field parse', lambda: markup.parse(LARGE_FIELD), 3)
+    report('large field locate sync spans', lambda: markup.locate_sync_spans(LARGE_FIELD), 3)
+
+
+def bench_strip():
+    for name, text in CLOZE_FIELDS.items():
+        report(f'strip {name} regex', lambda: RE_CLOZE.sub(r'\1', text), 10)
+        report(f'strip {name}', lambda: strip(text, Strip.CLOZE), 10)
+
+
+if __name__ == '__main__':
+    bench_parse()
+    bench_large_field()
+    bench_strip()
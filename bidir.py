@@ -13,52 +13,80 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import warnings
+import re
 from copy import copy
 from random import randrange
-from typing import Callable, Sequence
+from typing import Callable, NamedTuple, Sequence
 
 from anki.collection import Collection
 from anki.notes import Note, NoteId
-from aqt import mw
-from aqt.utils import askUserDialog
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from bs4 import BeautifulSoup, Tag
 
-warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning, module='bs4')
+from . import cas, index, markup
 
 GetActionCb = Callable[[str], str]
+ResolveCb = Callable[[Sequence[str]], dict[str, str]]  # sids -> 'Upload' or 'Download', missing sids are skipped
 
 
-def default_get_action_cb(sid: str) -> str:
+def default_resolve_cb(sids: Sequence[str]) -> dict[str, str]:
+    from aqt import mw
+
     config = mw.addonManager.getConfig(__name__)
     bidir_unfocus_action = config.get('bidir_unfocus_action', 'ask')
 
     if bidir_unfocus_action == 'upload':
-        return 'Upload'
+        return {sid: 'Upload' for sid in sids}
     else:  # bidir_unfocus_action == 'ask'
-        return askUserDialog(f'Span with sid {sid} has changed.', ['Upload', 'Download']).run()
+        from . import gui
+        return gui.ask_conflicts(sids)
+
+
+def default_get_action_cb(sid: str) -> str:
+    '''
+    Deprecated, kept for callers of sync_field: resolve a single sid with default_resolve_cb.
+    '''
+    return default_resolve_cb([sid]).get(sid, 'Skip')
+
+
+def each_sid(get_action_cb: GetActionCb) -> ResolveCb:
+    '''
+    Resolve conflicts by asking for every sid separately.
+    '''
+    return lambda sids: {sid: get_action_cb(sid) for sid in sids}
+
+
+def sid_search(sid: str) -> str:
+    '''
+    Return a search for the notes with spans with the sid. A regular
+    expression, wildcards do not match fields spanning several lines.
+    '''
+    # Only quotes are escaped in a quoted regular expression, backslashes are passed on
+    return '"*:re:' + f'sid="{re.escape(sid)}"'.replace('"', '\\"') + '"'
 
 
 def generate_sid(col: Collection, note: Note, field_idx: int) -> str:
     def generate_sid_internal():
         return f'{note.id}_{field_idx}_{randrange(0, 10000):04}'
     sid = generate_sid_internal()
-    while len(col.find_notes(f'*:*sid="{sid}"*')) > 0:
+    while len(col.find_notes(sid_search(sid))) > 0:
         sid = generate_sid_internal()
     return sid
 
 
-def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: int) -> bool:
+def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: int | str) -> bool:
     if len(nids) <= 1:
         return True
+    sid = str(sid)
 
     first_span = None
     for nid in nids:
         note = col.get_note(nid)
         for field_val in note.values():
-            bs = BeautifulSoup(field_val, 'html.parser')
-            spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-            for span in spans:
+            if sid not in field_val:
+                continue
+            for span in markup.SyncSpans(field_val).spans:
+                if span.get('sid') != sid:
+                    continue
                 if first_span is None:
                     first_span = span
                 elif first_span != span:
@@ -66,78 +94,275 @@ def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: int) -> boo
     return True
 
 
-def upload(col: Collection, nids: Sequence[NoteId], span: BeautifulSoup):
+def revision(span: Tag) -> int:
     '''
-    Upload a span to all given notes. Span must have a sid attribute.
+    Revision of a bidir span, increased on every upload. Spans without one have revision 0.
     '''
-    sid = span.get('sid')
+    rev = span.get('rev', '0')
+    return int(rev) if rev.isdigit() else 0
+
+
+def revise(span: Tag, rev: int, origin: NoteId) -> Tag:
+    '''
+    Return a copy of the span with the given revision, uploaded from the origin note.
+    '''
+    span_new = copy(span)
+    span_new['rev'] = str(rev)
+    span_new['origin'] = str(origin)
+    return span_new
+
+
+def note_revisions(col: Collection, nids: Sequence[NoteId], sid: str) -> dict[NoteId, int]:
+    '''
+    Return the highest revision of the spans with the sid in every note having one.
+    '''
+    revs = {}
     for nid in nids:
-        note = col.get_note(nid)
-        for field_key, field_val in note.items():
-            bs = BeautifulSoup(field_val, 'html.parser')
-            spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-            if len(spans) == 0:
+        for field_val in col.get_note(nid).fields:
+            if sid not in field_val:
                 continue
-            for other_span in spans:
-                other_span.replace_with(copy(span))
-            note[field_key] = bs.encode(formatter='html5').decode('utf-8')
-        col.update_note(note)
+            for span in markup.SyncSpans(field_val).spans:
+                if span.get('sid') == sid:
+                    revs[nid] = max(revs.get(nid, 0), revision(span))
+    return revs
 
 
-def download(col: Collection, nid: NoteId, sid: int):
+def upload_note(note: Note, span: Tag) -> bool:
+    '''
+    Replace spans of the note with the sid of span by its copies, in memory.
+    '''
+    sid = span.get('sid')
+    changed = False
+    for field_idx, text in enumerate(note.fields):
+        if 'sync' not in text:
+            continue
+        sync_spans = markup.SyncSpans(text)
+        spans = [other_span for other_span in sync_spans.spans if other_span.get('sid') == sid]
+        if len(spans) == 0:
+            continue
+        text_new = sync_spans.replace([(other_span, copy(span)) for other_span in spans])
+        if text_new != text:
+            note.fields[field_idx] = text_new
+            changed = True
+    return changed
+
+
+def upload(col: Collection, nids: Sequence[NoteId], span: BeautifulSoup):
+    '''
+    Upload a span to all given notes. Span must have a sid attribute.
+    '''
+    notes = [col.get_note(nid) for nid in nids]
+    changed = [note for note in notes if upload_note(note, span)]
+    if len(changed) > 0:
+        col.update_notes(changed)
+
+
+def download(col: Collection, nid: NoteId, sid: int | str):
     '''
     Return value of random span with the sid given notes to search in.
     '''
+    sid = str(sid)
     note = col.get_note(nid)
     for field_val in note.values():
-        bs = BeautifulSoup(field_val, 'html.parser')
-        spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-        if len(spans) > 0:
-            return spans[0]
+        if sid not in field_val:
+            continue
+        for span in markup.SyncSpans(field_val).spans:
+            if span.get('sid') == sid:
+                return span
     return None
 
 
-def sync_field(col: Collection, this_note: Note, field_idx: int,
-               get_action_cb: GetActionCb = default_get_action_cb) -> bool:
-    if this_note.id == 0:
-        return False  # the card is being created
-    if field_idx < 0 or field_idx >= len(this_note.values()):
-        return False  # should not happen
+def incoherent_groups(col: Collection) -> dict[str, list[NoteId]]:
+    '''
+    Return notes of every sid whose spans differ, looked up in a freshly built index.
+    '''
+    groups = {}
+    for sid, nids in index.rebuild(col).sids.items():
+        nids = sorted(nids)
+        if not are_spans_coherent(col, nids, sid):
+            groups[sid] = nids
+    return groups
+
 
+def reconcile_newest(col: Collection) -> int:
+    '''
+    Make spans of every incoherent sid equal to the copy with the highest
+    revision, the most recently modified note breaking ties. Return the
+    number of reconciled sids.
+    '''
+    groups = incoherent_groups(col)
+    for sid, nids in groups.items():
+        revs = note_revisions(col, nids, sid)
+        winner = max(nids, key=lambda nid: (revs[nid], col.get_note(nid).mod))
+        span = download(col, winner, sid)
+        if list(revs.values()).count(revs[winner]) > 1:
+            # Copies of the same revision differ, the winner becomes a new one
+            span = revise(span, max(revs.values()) + 1, winner)
+        # The winner's own copies are rewritten only if they differ
+        upload(col, nids, span)
+    return len(groups)
+
+
+def assign_sids(col: Collection, note: Note) -> bool:
+    '''
+    Give a sid to every bidir span without one, in memory. Other spans are left as they are.
+    '''
     changed = False
-    bs = BeautifulSoup(this_note.values()[field_idx], 'html.parser')
-
-    # recursive=False: transitive references are not propagated (only top spans are synced)
-    spans = bs.find_all('span', {'class': 'sync', 'note': False}, recursive=False)
-    for span in spans:
-        if not span.has_attr('sid'):
-            sid = generate_sid(col, this_note, field_idx)
-            span['sid'] = sid
-            changed = True
+    for field_idx, text in enumerate(note.fields):
+        if 'sync' not in text:
             continue
+        sync_spans = markup.SyncSpans(text)
+        replacements = []
+        for span in sync_spans.spans:
+            if span.has_attr('note') or span.has_attr('sid'):
+                continue
+            span_new = copy(span)
+            span_new['sid'] = generate_sid(col, note, field_idx)
+            replacements.append((span, span_new))
+        if len(replacements) > 0:
+            note.fields[field_idx] = sync_spans.replace(replacements)
+            changed = True
+    return changed
+
+
+class Field(NamedTuple):
+    note: Note
+    idx: int
+    sync_spans: markup.SyncSpans
+    spans: list[Tag]  # top level bidir spans
+
+
+def sync_fields(col: Collection, fields: Sequence[tuple[Note, int]],
+                resolve_cb: ResolveCb = default_resolve_cb,
+                versions: dict[NoteId, cas.Version] | None = None, undo: cas.UndoStep | None = None,
+                changed: dict[NoteId, Note] | None = None) -> bool:
+    '''
+    Sync bidir spans of the given fields, which may belong to several notes.
+
+    Conflicts of all fields are collected first and resolved by a single call
+    of resolve_cb, then every changed note is written in one batch, along
+    with the notes the caller changed in memory before if given.
+
+    Syncs running in the background pass versions of the notes of the fields,
+    see cas.version. The batch is then written only if none of its notes
+    changed since they were read, otherwise cas.ConflictError is raised.
+    The write joins the undo step if given.
+    '''
+    parsed: list[Field] = []
+    pending: dict[str, list[Tag]] = {}  # sid -> spans of the fields with the sid
+    for note, field_idx in fields:
+        if note.id == 0:
+            continue  # the card is being created
+        if field_idx < 0 or field_idx >= len(note.fields):
+            continue  # should not happen
+        sync_spans = markup.SyncSpans(note.fields[field_idx])
+        # Only top spans are synced, transitive references are not propagated
+        spans = [span for span in sync_spans.spans if not span.has_attr('note')]
+        parsed.append(Field(note, field_idx, sync_spans, spans))
+        for span in spans:
+            if span.has_attr('sid'):
+                pending.setdefault(span['sid'], []).append(span)
+
+    # Notes of the fields are edited in place, other notes are loaded once
+    notes = {field.note.id: field.note for field in parsed}
+    nids_by_sid = {}
+    for sid in pending:
+        # Spans may carry other attributes before the sid, e.g. their revision
+        nids = col.find_notes(sid_search(sid))
+        if not are_spans_coherent(col, nids, sid):
+            nids_by_sid[sid] = nids
 
-        sid = span['sid']
-        nids = col.find_notes(f'"*:*<span class=\\"sync\\" sid=\\"{sid}\\">*"')
-        if are_spans_coherent(col, nids, sid):
+    # Copies with a higher revision win without asking, empty spans are always downloaded
+    actions = {}
+    revs: dict[str, tuple[int, dict[NoteId, int]]] = {}  # sid -> revision in the fields, revisions of other notes
+    for sid, nids in nids_by_sid.items():
+        others = note_revisions(col, [nid for nid in nids if nid not in notes], sid)
+        rev = max(revision(span) for span in pending[sid])
+        revs[sid] = (rev, others)
+        peer_rev = max(others.values(), default=-1)
+        newest = [span for span in pending[sid] if revision(span) == rev]
+        if rev > peer_rev and all(span == newest[0] for span in newest):
+            actions[sid] = 'Propagate'
+        elif len(others) > 0 and (rev < peer_rev or all(len(span.contents) == 0 for span in pending[sid])):
+            actions[sid] = 'Download'
+    conflicts = [sid for sid in nids_by_sid if sid not in actions]
+    if len(conflicts) > 0:
+        actions.update({sid: 'Skip' for sid in conflicts})
+        actions.update(resolve_cb(conflicts))
+
+    sources: dict[str, Tag] = {}  # sid -> span all copies are replaced by
+    changed = dict(changed or {})
+    for sid in nids_by_sid:
+        action = actions[sid]
+        rev, others = revs[sid]
+        source = max((span for span in pending[sid] if len(span.contents) > 0),
+                     key=revision, default=pending[sid][0])
+        if action == 'Download' and len(others) == 0:
+            # All copies are in the fields, the newest of them is taken as it is
+            sources[sid] = source
+        elif action in ('Upload', 'Propagate'):
+            if action == 'Upload':
+                # A local change, it supersedes all copies
+                owner = next(field.note.id for field in parsed if source in field.spans)
+                source = revise(source, max([rev, *others.values()]) + 1, owner)
+            sources[sid] = source
+            # Only copies older than the uploaded one are touched
+            for nid, other_rev in others.items():
+                if other_rev > revision(source):
+                    continue
+                # Notes sharing several sids with the fields get all of them
+                note = changed.get(nid)
+                if note is None:
+                    note = col.get_note(nid)
+                    if versions is not None:
+                        versions[nid] = cas.version(note)
+                if upload_note(note, source):
+                    changed[nid] = note
+        elif action == 'Download':
+            sources[sid] = download(col, max(others, key=others.get), sid)
+
+    for field in parsed:
+        text = field.note.fields[field.idx]
+        replacements = []
+        for span in field.spans:
+            if not span.has_attr('sid'):
+                span_new = copy(span)
+                span_new['sid'] = generate_sid(col, field.note, field.idx)
+                replacements.append((span, span_new))
+            elif span['sid'] in sources and span != sources[span['sid']]:
+                replacements.append((span, copy(sources[span['sid']])))
+        if len(replacements) == 0:
             continue
+        # Only the span regions are rewritten, the note is updated only if its bytes changed
+        text_new = field.sync_spans.replace(replacements)
+        if text_new != text:
+            field.note.fields[field.idx] = text_new
+            changed[field.note.id] = field.note
 
-        if len(span.contents) == 0:
-            action = 'Download'
-        else:
-            action = get_action_cb(sid)
+    if len(changed) == 0:
+        return False
+    if versions is None:
+        col.update_notes(list(changed.values()))
+    else:
+        # Copies of a sid are written together or not at all
+        cas.write_all(col, list(changed.values()), versions, undo)
+    return True
 
-        if this_note.id in nids:
-            nids.remove(this_note.id)
 
-        if action == 'Upload':
-            upload(col, nids, span)
-        else:
-            # Idx 0 will always exist. If len(nids) == 1, spans are always coherent
-            span.replace_with(download(col, nids[0], sid))
+def sync_field(col: Collection, this_note: Note, field_idx: int,
+               get_action_cb: GetActionCb | None = None,
+               resolve_cb: ResolveCb = default_resolve_cb) -> bool:
+    '''
+    Sync bidir spans of a field. A get_action_cb is asked for every conflicting sid separately.
+    '''
+    if get_action_cb is not None:
+        resolve_cb = each_sid(get_action_cb)
+    return sync_fields(col, [(this_note, field_idx)], resolve_cb)
 
-        changed = True
 
-    if changed:
-        this_note.values()[field_idx] = bs.encode(formatter='html5').decode('utf-8')
-        col.update_note(this_note)
-    return changed
+def sync_note(col: Collection, note: Note, resolve_cb: ResolveCb = default_resolve_cb,
+              versions: dict[NoteId, cas.Version] | None = None) -> bool:
+    '''
+    Sync bidir spans of all fields of a note, resolving their conflicts at once.
+    '''
+    return sync_fields(col, [(note, field_idx) for field_idx in range(len(note.fields))], resolve_cb, versions)
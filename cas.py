@@ -0,0 +1,158 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compare-and-swap writes of notes synced in the background. A note is written
+# only if it is stored as it was read, so edits made meanwhile are never lost.
+
+from typing import Callable, Iterable, NamedTuple, Sequence
+
+import anki.errors
+from anki.collection import Collection, OpChanges
+from anki.notes import Note, NoteId
+from anki.utils import ids2str, join_fields
+
+RETRIES = 3  # times a note changed meanwhile is loaded and updated again
+SQL_VERSIONS = 'select id, mod, flds, tags from notes where id in {}'
+
+UpdateCb = Callable[[Collection, Note], bool]
+
+
+class Version(NamedTuple):
+    mod: int
+    # Modification times have a resolution of seconds, an edit made in the
+    # same second as the read is told apart by the fields and tags
+    flds: str
+    tags: str  # separated by single spaces, stored with a space around them
+
+
+class ConflictError(Exception):
+    '''
+    Notes changed since they were read, nothing was written.
+    '''
+    def __init__(self, nids: Sequence[NoteId]):
+        super().__init__('Notes changed meanwhile')
+        self.nids = nids
+
+
+class UndoStep():
+    '''
+    Undo step the writes of a background operation are merged into. An
+    operation triggered by a change joins the step of the change, recorded on
+    the main thread when it finished, as long as it is still the last step.
+    Otherwise the writes get a step of their own, added before the first write.
+    '''
+    def __init__(self, step: int, label: str):
+        self.step = step
+        self.label = label
+        self.target: int | None = None
+
+    def begin(self, col: Collection):
+        if self.target is not None:
+            return
+        if self.step > 0 and col.undo_status().last_step == self.step:
+            self.target = self.step
+        else:
+            self.target = col.add_custom_undo_entry(self.label)
+
+    def merge(self, col: Collection) -> OpChanges:
+        '''
+        Merge the writes into the step and return their changes, nothing if nothing was written.
+        '''
+        if self.target is None:
+            return OpChanges()
+        return col.merge_undo_entries(self.target)
+
+
+def version(note: Note) -> Version:
+    '''
+    Return the version of a note as loaded, record it before updating the note in memory.
+    '''
+    return Version(note.mod, join_fields(note.fields), ' '.join(note.tags))
+
+
+def stored_versions(col: Collection, nids: Iterable[NoteId]) -> dict[NoteId, Version]:
+    return {nid: Version(mod, flds, ' '.join(tags.split()))
+            for nid, mod, flds, tags in col.db.execute(SQL_VERSIONS.format(ids2str(nids)))}
+
+
+def conflicts(col: Collection, versions: dict[NoteId, Version]) -> list[NoteId]:
+    '''
+    Return ids of the notes that changed or were deleted since their versions were recorded.
+    '''
+    stored = stored_versions(col, versions.keys())
+    return [nid for nid, recorded in versions.items() if stored.get(nid) != recorded]
+
+
+def write(col: Collection, notes: Sequence[Note], versions: dict[NoteId, Version],
+          undo: UndoStep | None = None) -> list[NoteId]:
+    '''
+    Write the notes that did not change since their versions were recorded and
+    return ids of the others, which are left unwritten. The writes join the
+    undo step if given, see UndoStep.merge.
+    '''
+    if len(notes) == 0:
+        return []
+    conflicting = conflicts(col, {note.id: versions[note.id] for note in notes})
+    skipped = set(conflicting)
+    fresh = [note for note in notes if note.id not in skipped]
+    if len(fresh) > 0:
+        if undo is not None:
+            undo.begin(col)
+        col.update_notes(fresh)
+    return conflicting
+
+
+def write_all(col: Collection, notes: Sequence[Note], versions: dict[NoteId, Version],
+              undo: UndoStep | None = None):
+    '''
+    Write all the notes, or none of them if any note with a recorded version
+    changed since, including notes only read to update the others.
+    '''
+    conflicting = conflicts(col, versions)
+    if len(conflicting) > 0:
+        raise ConflictError(conflicting)
+    if undo is not None:
+        undo.begin(col)
+    col.update_notes(notes)
+
+
+def update(col: Collection, nids: Sequence[NoteId], update_cb: UpdateCb,
+           progress: Callable[[int], None] | None = None, retries: int = RETRIES,
+           undo: UndoStep | None = None) -> list[NoteId]:
+    '''
+    Load the notes, update them in memory with update_cb and write the changed
+    ones. Notes changed meanwhile are loaded and updated again, up to retries
+    times, and left as they are afterwards. Return ids of the written notes.
+    '''
+    written = []
+    for attempt in range(retries + 1):
+        versions = {}
+        changed = []
+        for i, nid in enumerate(nids):
+            if progress is not None and attempt == 0:
+                progress(i)
+            try:
+                note = col.get_note(nid)
+            except anki.errors.NotFoundError:
+                continue  # deleted meanwhile
+            versions[nid] = version(note)
+            if update_cb(col, note):
+                changed.append(note)
+        nids = write(col, changed, versions, undo)
+        skipped = set(nids)
+        written += [note.id for note in changed if note.id not in skipped]
+        if len(nids) == 0:
+            break
+    return written
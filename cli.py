@@ -0,0 +1,102 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Synchronize collections without Anki's GUI. Run from the parent directory:
+#   python -m notesync.cli [-j JOBS] [--bidir newest] collection.anki2 [...]
+# Anki must not have the collections open.
+
+import argparse
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Sequence
+
+from anki.collection import Collection
+
+from . import batch, bidir
+
+SQL_SYNC_NOTES = 'select id from notes where flds like \'%class="sync"%\''
+
+
+class Result(NamedTuple):
+    path: str
+    notes: int  # updated notes
+    reconciled: int  # reconciled sids
+    seconds: float
+
+
+def sync_collection(path: str, bidir_policy: str = 'skip', verbose: bool = False) -> Result:
+    '''
+    Assign sids, render unidir blocks and optionally reconcile bidir spans of a collection.
+    '''
+    def progress(value: int, max: int):
+        if verbose and value % 1000 == 0:
+            print(f'{path}: {value}/{max}', file=sys.stderr, flush=True)
+
+    started = time.perf_counter()
+    col = Collection(path)
+    try:
+        result = batch.sync_notes(col, col.db.list(SQL_SYNC_NOTES), 'Sync notes', progress)
+        reconciled = bidir.reconcile_newest(col) if bidir_policy == 'newest' else 0
+    finally:
+        col.close()
+    return Result(path, result.count, reconciled, time.perf_counter() - started)
+
+
+def sync_collections(paths: Sequence[str], jobs: int = 1, bidir_policy: str = 'skip',
+                     verbose: bool = False) -> list[Result | Exception]:
+    '''
+    Synchronize the collections, each in its own process if jobs > 1.
+    A collection that failed is reported by its exception.
+    '''
+    if jobs <= 1 or len(paths) <= 1:
+        results: list[Result | Exception] = []
+        for path in paths:
+            try:
+                results.append(sync_collection(path, bidir_policy, verbose))
+            except Exception as e:
+                results.append(e)
+        return results
+    with ProcessPoolExecutor(min(jobs, len(paths)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(sync_collection, path, bidir_policy, verbose) for path in paths]
+        return [future.exception() or future.result() for future in futures]
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='notesync', description='Synchronize sync blocks of Anki collections.')
+    parser.add_argument('collections', nargs='+', metavar='collection.anki2')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='collections processed in parallel')
+    parser.add_argument('--bidir', choices=('skip', 'newest'), default='skip',
+                        help='reconcile differing bidirectional spans to the copy with the highest revision, '
+                             'the most recently modified one breaking ties')
+    parser.add_argument('-v', '--verbose', action='store_true', help='report progress')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    failed = False
+    for path, result in zip(args.collections, sync_collections(args.collections, args.jobs, args.bidir, args.verbose)):
+        if isinstance(result, Exception):
+            print(f'{path}: {type(result).__name__}: {result}', file=sys.stderr)
+            failed = True
+        else:
+            print(f'{path}: {result.notes} notes updated, {result.reconciled} sids reconciled '
+                  f'in {result.seconds:.2f} s')
+    print(f'total: {time.perf_counter() - started:.2f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,403 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+import weakref
+from typing import Callable, Sequence
+
+import aqt
+from anki.collection import Collection, OpChanges
+from anki.notes import Note, NoteId
+from aqt import gui_hooks, mw
+from aqt.browser import Browser
+from aqt.editor import Editor
+from aqt.operations import CollectionOp, QueryOp
+from aqt.qt import (QAction, QComboBox, QDialog, QDialogButtonBox, QFormLayout, QLabel, QObject, Qt, QTimer,
+                    QVBoxLayout, QWidget)
+from aqt.utils import showText, tooltip
+
+from . import batch, bidir, index, scheduler
+
+MAX_LINKS = 10
+
+
+def open_browser(nids: str):
+    aqt.dialogs.open('Browser', mw, search=(f'nid:{nids}',))
+
+
+def _links(nids: Sequence[NoteId]) -> str:
+    links = [f'<a href="{nid}">{nid}</a>' for nid in nids[:MAX_LINKS]]
+    if len(nids) > MAX_LINKS:
+        links.append(f'<a href="{",".join(map(str, nids))}">all {len(nids)}</a>')
+    return ', '.join(links)
+
+
+_editors: 'weakref.WeakSet[Editor]' = weakref.WeakSet()
+
+# Set field contents through the note editor's stores, unchanged fields keep
+# their state. Returns false if the editor exposes no such API.
+JS_SET_FIELDS = '''(() => {
+    try {
+        const fields = require("anki/NoteEditor").instances[0].fields;
+        const updates = %s;
+        if (!updates.every(([idx]) => fields[idx]?.editingArea?.content)) {
+            return false;
+        }
+        for (const [idx, html] of updates) {
+            fields[idx].editingArea.content.set(html);
+        }
+        return true;
+    } catch (e) {
+        return false;
+    }
+})()'''
+
+
+def on_editor_did_init(editor: Editor):
+    # Panel below the fields listing notes synced with the edited one
+    panel = QLabel(editor.widget)
+    panel.setTextFormat(Qt.TextFormat.RichText)
+    panel.setWordWrap(True)
+    panel.linkActivated.connect(open_browser)
+    panel.hide()
+    editor.outerLayout.addWidget(panel)
+    editor.notesync_panel = panel
+    _editors.add(editor)
+
+
+def on_editor_did_load_note(editor: Editor):
+    panel = getattr(editor, 'notesync_panel', None)
+    if panel is None:
+        return
+    note = editor.note
+    if note is None or note.id == 0:
+        panel.hide()
+        return
+
+    sync_index = index.current(editor.mw.col)
+    if sync_index is None:
+        panel.hide()  # still being built
+        return
+    # Only the loaded note is read on the main thread, other notes are as of the last refresh
+    sync_index.refresh_notes(editor.mw.col, [note.id])
+    report = sync_index.report(note.id)
+    lines = []
+    if len(report.referencing) > 0:
+        lines.append(f'Referenced by {len(report.referencing)} notes: {_links(report.referencing)}')
+    for sid, nids in report.peers.items():
+        if len(nids) > 0:
+            lines.append(f'Span {sid} shared with {len(nids)} notes: {_links(nids)}')
+    panel.setText('<br>'.join(lines))
+    panel.setVisible(len(lines) > 0)
+
+
+def refresh_fields(note: Note, fields: Sequence[int]) -> bool:
+    '''
+    Push the given fields of the note into the editor showing it instead of
+    reloading the whole note, which would reset scrolling and the caret.
+    Return False if no editor shows the note.
+    '''
+    editor = next((editor for editor in _editors if editor.note is note), None)
+    if editor is None:
+        return False
+    updates = [(idx, editor.mw.col.media.escape_media_filenames(note.fields[idx])) for idx in fields]
+
+    def on_done(done: bool):
+        if editor.note is not note:
+            return  # another note was loaded meanwhile
+        if done:
+            on_editor_did_load_note(editor)
+        else:
+            editor.loadNoteKeepingFocus()
+
+    editor.web.evalWithCallback(JS_SET_FIELDS % json.dumps(updates), on_done)
+    return True
+
+
+ACTIONS = ['Upload', 'Download', 'Skip']
+
+
+def ask_conflicts(sids: Sequence[str]) -> dict[str, str]:
+    '''
+    Ask how to resolve all conflicting sids in a single dialog.
+    Nothing is resolved if the dialog is cancelled.
+    '''
+    dialog = QDialog(mw)
+    dialog.setWindowTitle('Changed sync spans')
+    layout = QVBoxLayout(dialog)
+    layout.addWidget(QLabel(f'{len(sids)} spans have changed. Upload them to other notes or download them?'))
+
+    form = QFormLayout()
+    all_choice = QComboBox()
+    all_choice.addItems(['Apply to all...'] + ACTIONS)
+    form.addRow('All spans', all_choice)
+    choices = {}
+    for sid in sids:
+        choices[sid] = QComboBox()
+        choices[sid].addItems(ACTIONS)
+        form.addRow(f'Span {sid}', choices[sid])
+    layout.addLayout(form)
+
+    def apply_to_all(index: int):
+        if index > 0:
+            for choice in choices.values():
+                choice.setCurrentIndex(index - 1)
+    all_choice.currentIndexChanged.connect(apply_to_all)
+
+    buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+    buttons.accepted.connect(dialog.accept)
+    buttons.rejected.connect(dialog.reject)
+    layout.addWidget(buttons)
+
+    if dialog.exec() != QDialog.DialogCode.Accepted:
+        return {}
+    return {sid: choice.currentText() for sid, choice in choices.items()}
+
+
+def ask_conflicts_from_op(sids: Sequence[str]) -> dict[str, str]:
+    '''
+    ask_conflicts for operations running in the background: the dialog is
+    shown on the main thread while the operation waits for the answers.
+    '''
+    answered = threading.Event()
+    answers = {}
+
+    def ask():
+        try:
+            answers.update(ask_conflicts(sids))
+        finally:
+            answered.set()
+
+    mw.taskman.run_on_main(ask)
+    answered.wait()
+    return answers
+
+
+def run_sync_op(parent: QWidget, label: str, get_nids: Callable[[Collection], Sequence[NoteId]],
+                resolve_cb: bidir.ResolveCb | None = None):
+    '''
+    Sync the notes in the background as a single undo step, showing progress.
+    Bidir spans are synced too if given a resolve_cb, see batch.sync_notes.
+    '''
+    def update_progress(value: int, max: int):
+        if value % 100 == 0:
+            mw.taskman.run_on_main(lambda: mw.progress.update(label=label, value=value, max=max))
+
+    def op(col: Collection) -> batch.SyncResult:
+        return batch.sync_notes(col, get_nids(col), label, update_progress, resolve_cb)
+
+    def on_success(result: batch.SyncResult):
+        if result.count > 0:
+            tooltip(f'{label}: {result.count} notes updated', parent=parent)
+
+    CollectionOp(parent, op).success(on_success).run_in_background()
+
+
+def on_browser_menus_did_init(browser: Browser):
+    action = QAction('Sync Selected Notes', browser)
+    action.triggered.connect(lambda: sync_selected_notes(browser))
+    browser.form.menu_Notes.addSeparator()
+    browser.form.menu_Notes.addAction(action)
+
+
+def sync_selected_notes(browser: Browser):
+    nids = browser.selected_notes()
+    if len(nids) == 0:
+        return
+    run_sync_op(browser, 'Sync notes', lambda _: nids, ask_conflicts_from_op)
+
+
+def propagate_changes(step: int):
+    '''
+    Re-render notes including the notes changed by an operation, merged into
+    its undo step. Changed notes are looked up in the background, their
+    dependents' own changes are propagated further when the update finishes.
+    '''
+    def op(col: Collection) -> list[NoteId]:
+        # Refreshed first, the notes changed since the collection was opened are returned if it builds the index
+        changed = index.changed_notes(col)
+        return index.get(col).dependents(changed)
+
+    def on_success(dependents: list[NoteId]):
+        if len(dependents) > 0 and mw.col is not None:
+            CollectionOp(mw, lambda col: batch.update_dependents(col, dependents, step)).run_in_background()
+
+    QueryOp(parent=mw, op=op, success=on_success).run_in_background()
+
+
+def build_index(fill: bool = False):
+    '''
+    Build the index in the background, so that changes are propagated from the
+    first edit. With fill, all its work is queued for idle sync once it is built.
+    '''
+    def on_success(rebuilt: index.SyncIndex):
+        if mw.col is None:
+            return
+        # Built on demand meanwhile
+        if not index.is_built(mw.col):
+            index.install(mw.col, rebuilt)
+        if fill:
+            start_idle_sync(fill=True)
+
+    QueryOp(parent=mw, op=lambda col: index.rebuild(col, None), success=on_success).run_in_background()
+
+
+def sync_imported_notes(nids: Sequence[NoteId]):
+    if len(nids) > 0 and mw.col is not None:
+        run_sync_op(mw, 'Sync imported notes', lambda _: nids, ask_conflicts_from_op)
+
+
+ADDED_DELAY = 300  # ms to wait for further notes before syncing added notes
+_added: list[tuple[NoteId, int]] = []  # notes with the undo steps that added them
+
+
+def on_add_cards_did_add_note(note: Note):
+    # Unfocusing fields of a note that is not added yet syncs nothing, the
+    # added notes are synced in one background operation shortly afterwards
+    if not any('sync' in field for field in note.fields):
+        return
+    if len(_added) == 0:
+        mw.progress.single_shot(ADDED_DELAY, sync_added_notes)
+    # Recorded right after the addition finished, later steps may be added before the sync runs
+    _added.append((note.id, mw.col.undo_status().last_step))
+
+
+def sync_added_notes():
+    added = _added.copy()
+    _added.clear()
+    if mw.col is not None:
+        CollectionOp(mw, lambda col: batch.sync_added_notes(col, added, ask_conflicts_from_op)).run_in_background()
+
+
+def on_index_checked(rebuilt: index.SyncIndex):
+    if mw.col is None:
+        return
+    problems = index.install(mw.col, rebuilt)
+    if problems:
+        showText('Sync index was rebuilt, it was inconsistent:\n'
+                 f'notes missing: {problems.missing}\n'
+                 f'notes without sync blocks: {problems.extra}\n'
+                 f'notes with stale entries: {problems.stale}', parent=mw)
+    else:
+        tooltip(f'Sync index checked: {len(rebuilt.entries)} notes with sync blocks', parent=mw)
+
+
+IDLE_DELAY = 2.0  # seconds without user activity before background work starts
+SLICE_INTERVAL = 200  # ms between slices
+SLICE_BUDGET = 0.03  # seconds of work per slice
+
+
+class IdleSync(QObject):
+    '''
+    Run the scheduler in short background slices while the user does nothing.
+
+    Activity is told by the hooks of editors, the reviewer, web views, focus
+    and state changes instead of filtering every input event of the
+    application. Nothing runs during reviews: answer keys are shortcuts
+    reported by no hook, and a slice would redraw the card and bury the
+    answer's undo step.
+    '''
+    def __init__(self):
+        super().__init__(mw)
+        self.scheduler = scheduler.Scheduler()
+        self.last_activity = time.monotonic()
+        self.running = False  # a slice is running in the background
+        self.timer = QTimer(self)
+        self.timer.setInterval(SLICE_INTERVAL)
+        self.timer.timeout.connect(self.on_timeout)
+        gui_hooks.editor_did_fire_typing_timer.append(self.on_activity)
+        gui_hooks.reviewer_did_show_question.append(self.on_activity)
+        gui_hooks.reviewer_did_answer_card.append(self.on_activity)
+        gui_hooks.focus_did_change.append(self.on_activity)
+        gui_hooks.state_did_change.append(self.on_activity)
+        gui_hooks.webview_did_receive_js_message.append(self.on_js_message)
+
+    def on_activity(self, *args):
+        self.last_activity = time.monotonic()
+
+    def on_js_message(self, handled: tuple[bool, object], message: str, context: object) -> tuple[bool, object]:
+        # Clicks and keys of the reviewer, the deck browser and the editor reach Python as messages
+        self.last_activity = time.monotonic()
+        return handled
+
+    def start(self):
+        if self.scheduler and not self.timer.isActive():
+            self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.scheduler.clear()
+
+    def on_timeout(self):
+        if not self.scheduler or mw.col is None:
+            self.timer.stop()
+            return
+        if self.running or time.monotonic() - self.last_activity < IDLE_DELAY or mw.progress.busy():
+            return
+        if mw.state == 'review':
+            return
+        # Notes open in the browser or an editor are not changed behind the user's back
+        if any(instance is not None for _, instance in aqt.dialogs._dialogs.values()):
+            return
+
+        def op(col: Collection) -> OpChanges:
+            # Slices are merged into a single undo step, see Scheduler.run
+            updated = self.scheduler.run(col, SLICE_BUDGET)
+            return OpChanges(note_text=True) if len(updated) > 0 else OpChanges()
+
+        def on_done(_):
+            self.running = False
+
+        def on_failure(exc: Exception):
+            self.running = False
+            self.stop()
+            showText(f'Background sync stopped: {exc}', parent=mw)
+
+        self.running = True
+        CollectionOp(mw, op).success(on_done).failure(on_failure).run_in_background()
+
+
+idle_sync: IdleSync | None = None
+
+
+def start_idle_sync(fill: bool = False):
+    global idle_sync
+    if idle_sync is None:
+        idle_sync = IdleSync()
+    if fill:
+        # The index is read in the background, where it may be refreshed
+        QueryOp(parent=mw, op=idle_sync.scheduler.fill, success=lambda _: idle_sync.start()).run_in_background()
+    else:
+        idle_sync.start()
+
+
+def queue_changed_notes():
+    '''
+    Queue the work following the notes changed since the last refresh, e.g. by an AnkiWeb sync.
+    '''
+    if idle_sync is None:
+        return
+
+    def op(col: Collection):
+        idle_sync.scheduler.add_changed(col, index.changed_notes(col))
+
+    QueryOp(parent=mw, op=op, success=lambda _: idle_sync.start()).run_in_background()
+
+
+def stop_idle_sync():
+    if idle_sync is not None:
+        idle_sync.stop()
@@ -0,0 +1,398 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterable, Iterator, NamedTuple, Sequence
+
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+from anki.utils import ids2str, split_fields
+
+from . import markup
+
+
+class Entry(NamedTuple):
+    notes: frozenset[str]  # values of note attributes of unidir spans
+    sids: frozenset[str]  # values of sid attributes of bidir spans
+
+
+class SyncReport(NamedTuple):
+    referencing: list[NoteId]  # notes including the note via note=
+    peers: dict[str, list[NoteId]]  # other notes sharing a sid with the note
+
+
+class Verification(NamedTuple):
+    missing: list[NoteId]  # notes with sync spans not in the index
+    extra: list[NoteId]  # indexed notes without sync spans
+    stale: list[NoteId]  # notes indexed with other spans than they have
+
+    def __bool__(self) -> bool:
+        return len(self.missing) > 0 or len(self.extra) > 0 or len(self.stale) > 0
+
+
+class SpanScanner(HTMLParser):
+    '''
+    Collect top level sync spans without building a tree.
+
+    Tags are nested exactly as BeautifulSoup's html.parser builder nests
+    them: a void element is closed right away unless written as <x/>, an end
+    tag closes the innermost open tag of the same name, and an end tag
+    matching an already closed void element is skipped once.
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open: list[str] = []
+        self.closed: list[str] = []  # void elements closed on their start tag
+        self.spans: list[dict[str, str | None]] = []  # attributes of the top level sync spans
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]], close_void: bool = True):
+        if tag == 'span' and len(self.open) == 0:
+            values = dict(attrs)  # the last duplicate attribute wins
+            if 'sync' in (values.get('class') or '').split():
+                self.spans.append(values)
+        if tag in markup.VOID_TAGS and close_void:
+            self.closed.append(tag)
+        else:
+            self.open.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        self.handle_starttag(tag, attrs, close_void=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag: str):
+        if tag in self.closed:
+            self.closed.remove(tag)
+            return
+        for i in range(len(self.open) - 1, -1, -1):
+            if self.open[i] == tag:
+                del self.open[i:]
+                return
+
+    def scan(self, text: str):
+        self.open.clear()
+        self.closed.clear()
+        self.spans.clear()
+        self.reset()
+        self.feed(text)
+        self.close()
+
+
+def span_attrs(text: str) -> list[dict]:
+    '''
+    Return attributes of the top level sync spans of a field without building its tree.
+    Raises AssertionError for markup rejected by html.parser.
+    '''
+    located = markup.locate_sync_spans(text)
+    if located is not None:
+        return [span.element.attrs for span in located]
+    scanner = SpanScanner()
+    scanner.scan(text)
+    return scanner.spans
+
+
+def scan(fields: Iterable[str]) -> Entry:
+    '''
+    Collect top level sync spans of the given fields.
+    '''
+    notes = set()
+    sids = set()
+    for field in fields:
+        if 'sync' not in field:
+            continue
+        try:
+            spans = span_attrs(field)
+        except AssertionError:
+            continue  # rejected by html.parser, sync spans of the field cannot be synced either
+        for values in spans:
+            if 'note' in values:
+                notes.add(values['note'] or '')
+            elif 'sid' in values:
+                sids.add(values['sid'] or '')
+    return Entry(frozenset(notes), frozenset(sids))
+
+
+def scan_rows(rows: Sequence[tuple[NoteId, str]]) -> list[tuple[NoteId, Entry]]:
+    '''
+    Scan a chunk of (note id, joined fields) rows. Runs in worker processes.
+    '''
+    return [(nid, scan(split_fields(flds))) for nid, flds in rows]
+
+
+def parallel_executor(workers: int | None = None) -> Executor | None:
+    '''
+    Return a process pool for scanning, or None to scan in the calling process.
+
+    Frozen Anki builds cannot spawn Python workers, they always scan serially.
+    '''
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or getattr(sys, 'frozen', False):
+        return None
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+class SyncIndex():
+    '''
+    Reverse index of sync spans in a collection.
+
+    Built with a single pass over the notes table and refreshed incrementally
+    from note modification times, so lookups never search the collection.
+    '''
+    SQL_BUILD = 'select id, mod, flds from notes where flds like \'%class="sync"%\''
+    SQL_CHUNK = SQL_BUILD + ' and id > ? order by id limit ?'
+    # Notes changed locally have the update sequence number -1 until the next
+    # AnkiWeb sync, which gives notes it sends or pulls a higher one; pulled
+    # notes keep their remote modification time. Both are looked up through
+    # the index of the column, only notes changed since the last AnkiWeb sync
+    # are read instead of the whole table.
+    SQL_REFRESH = 'select id, mod, usn, flds from notes where usn > ? or usn = -1 and mod >= ?'
+    SQL_REFRESH_NOTES = 'select id, flds from notes where id in {}'
+
+    def __init__(self):
+        self.entries: dict[NoteId, Entry] = {}
+        self.referencing: dict[str, set[NoteId]] = {}
+        self.sids: dict[str, set[NoteId]] = {}
+        self.mod = 0  # newest modification time seen
+        self.usn = 0  # highest update sequence number seen, -1 marks local changes
+        self.dirty = False
+
+    def __add(self, nid: NoteId, entry: Entry):
+        self.entries[nid] = entry
+        for other_id in entry.notes:
+            self.referencing.setdefault(other_id, set()).add(nid)
+        for sid in entry.sids:
+            self.sids.setdefault(sid, set()).add(nid)
+
+    def __remove(self, nid: NoteId):
+        entry = self.entries.pop(nid, None)
+        if entry is None:
+            return
+        for other_id in entry.notes:
+            self.referencing[other_id].discard(nid)
+            if len(self.referencing[other_id]) == 0:
+                del self.referencing[other_id]
+        for sid in entry.sids:
+            self.sids[sid].discard(nid)
+            if len(self.sids[sid]) == 0:
+                del self.sids[sid]
+
+    def update(self, nid: NoteId, fields: Iterable[str]):
+        entry = scan(fields)
+        if self.entries.get(nid) == entry:
+            return
+        self.__remove(nid)
+        if len(entry.notes) > 0 or len(entry.sids) > 0:
+            self.__add(nid, entry)
+
+    def update_note(self, note: Note):
+        self.update(note.id, note.fields)
+
+    def remove(self, nids: Iterable[NoteId]):
+        for nid in nids:
+            self.__remove(nid)
+
+    def build(self, col: Collection, executor: Executor | None = None):
+        '''
+        Index all notes, reading them in chunks. Chunks are scanned by the
+        executor if given, otherwise in the calling thread.
+        '''
+        self.__init__()
+        self.mod = col.db.scalar('select max(mod) from notes') or 0
+        self.usn = col.db.scalar('select max(usn) from notes') or 0
+        chunks = self.__chunks(col)
+        scanned = map(scan_rows, chunks) if executor is None else executor.map(scan_rows, chunks)
+        for rows in scanned:
+            for nid, entry in rows:
+                if len(entry.notes) > 0 or len(entry.sids) > 0:
+                    self.__add(nid, entry)
+
+    def __chunks(self, col: Collection) -> Iterator[list[tuple[NoteId, str]]]:
+        last = 0
+        while True:
+            rows = col.db.all(self.SQL_CHUNK, last, CHUNK_SIZE)
+            if len(rows) == 0:
+                return
+            last = rows[-1][0]
+            self.mod = max(self.mod, max(mod for _, mod, _ in rows))
+            yield [(nid, flds) for nid, _, flds in rows]
+
+    def verify(self, other: 'SyncIndex') -> Verification:
+        '''
+        Compare the index with a freshly built one.
+        '''
+        missing = sorted(other.entries.keys() - self.entries.keys())
+        extra = sorted(self.entries.keys() - other.entries.keys())
+        stale = sorted(nid for nid in self.entries.keys() & other.entries.keys()
+                       if self.entries[nid] != other.entries[nid])
+        return Verification(missing, extra, stale)
+
+    def refresh(self, col: Collection) -> list[NoteId]:
+        '''
+        Index notes changed since the last refresh and return their ids.
+        '''
+        # Modification times have a resolution of seconds, notes changed in the
+        # same second as the last refresh are indexed again.
+        changed = []
+        for nid, mod, usn, flds in col.db.execute(self.SQL_REFRESH, self.usn, self.mod):
+            self.update(nid, split_fields(flds))
+            self.mod = max(self.mod, mod)
+            self.usn = max(self.usn, usn)
+            changed.append(nid)
+        self.dirty = False
+        return changed
+
+    def refresh_notes(self, col: Collection, nids: Sequence[NoteId]):
+        '''
+        Index the given notes only, they are indexed again by the next refresh().
+        '''
+        for nid, flds in col.db.execute(self.SQL_REFRESH_NOTES.format(ids2str(nids))):
+            self.update(nid, split_fields(flds))
+
+    def report(self, nid: NoteId) -> SyncReport:
+        return SyncReport(self.referencing_notes(nid), self.sid_peers(nid))
+
+    def referencing_notes(self, nid: NoteId) -> list[NoteId]:
+        return sorted(self.referencing.get(str(nid), ()))
+
+    def dependents(self, nids: Iterable[NoteId]) -> list[NoteId]:
+        found = set()
+        for nid in nids:
+            found.update(self.referencing.get(str(nid), ()))
+        return sorted(found)
+
+    def sid_peers(self, nid: NoteId) -> dict[str, list[NoteId]]:
+        entry = self.entries.get(nid)
+        if entry is None:
+            return {}
+        return {sid: sorted(self.sids[sid] - {nid}) for sid in sorted(entry.sids)}
+
+
+CHUNK_SIZE = 1000  # notes read and scanned at once
+PARALLEL_MIN_NOTES = 5000  # notes with sync spans worth scanning in parallel
+SQL_COUNT = 'select count() from notes where flds like \'%class="sync"%\''
+
+_indexes: dict[str, SyncIndex] = {}
+_opened: dict[str, int] = {}  # collection path -> modification time in seconds when opened
+
+
+def get(col: Collection) -> SyncIndex:
+    '''
+    Return an up to date index of the collection, building it on first use.
+    Reads the collection, the GUI calls it only in background operations, see current().
+    '''
+    index = _indexes.get(col.path)
+    if index is None:
+        index = _indexes[col.path] = SyncIndex()
+        index.build(col)
+    elif index.dirty:
+        index.refresh(col)
+    return index
+
+
+def current(col: Collection) -> SyncIndex | None:
+    '''
+    Return the index of the collection as it is, None if it is not built yet.
+    '''
+    return _indexes.get(col.path)
+
+
+def is_built(col: Collection) -> bool:
+    return col.path in _indexes
+
+
+def invalidate(col: Collection):
+    '''
+    Notes of the collection changed, refresh the index on next use.
+    '''
+    if col.path in _indexes:
+        _indexes[col.path].dirty = True
+
+
+def opened(col: Collection):
+    '''
+    The collection was opened, notes changed afterwards are returned by
+    changed_notes even if the index is built later.
+    '''
+    _opened[col.path] = col.mod // 1000
+
+
+def _since_opened(col: Collection, index: SyncIndex):
+    if col.path in _opened:
+        index.mod = min(index.mod, _opened[col.path])
+
+
+def changed_notes(col: Collection) -> list[NoteId]:
+    '''
+    Refresh the index and return notes changed since the last refresh.
+    When the index is built, notes changed since the collection was opened
+    are returned, see opened(), or nothing if that is not known.
+    '''
+    index = _indexes.get(col.path)
+    if index is None:
+        index = get(col)
+        if col.path not in _opened:
+            return []
+        _since_opened(col, index)
+    return index.refresh(col)
+
+
+def remove_notes(col: Collection, nids: Sequence[NoteId]):
+    if col.path in _indexes:
+        _indexes[col.path].remove(nids)
+
+
+def rebuild(col: Collection, workers: int | None = 1) -> SyncIndex:
+    '''
+    Build a new index of the collection without touching the current one, see install().
+    Chunks are scanned by the given number of worker processes, all cores if None.
+    '''
+    index = SyncIndex()
+    # Starting worker processes costs more than scanning a small collection
+    if workers != 1 and col.db.scalar(SQL_COUNT) < PARALLEL_MIN_NOTES:
+        workers = 1
+    executor = parallel_executor(workers)
+    try:
+        index.build(col, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return index
+
+
+def install(col: Collection, index: SyncIndex) -> Verification:
+    '''
+    Replace the current index of the collection with a rebuilt one and
+    return how the current one differed from it.
+    '''
+    current = _indexes.get(col.path)
+    _indexes[col.path] = index
+    if current is None:
+        _since_opened(col, index)
+        return Verification([], [], [])
+    if current.dirty:
+        current.refresh(col)
+    return current.verify(index)
+
+
+def drop(col: Collection):
+    _indexes.pop(col.path, None)
+    _opened.pop(col.path, None)
+
+
+def report(col: Collection, nid: NoteId) -> SyncReport:
+    return get(col).report(nid)
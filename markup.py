@@ -0,0 +1,354 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import warnings
+from html.entities import html5 as HTML5_ENTITIES
+from typing import NamedTuple, Sequence
+
+from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning, PageElement, Tag
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning, module='bs4')
+
+BACKENDS = ('html.parser', 'lxml')
+
+RE_TAG = re.compile(r'<(/?)([a-zA-Z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>|<[!?]')
+RE_ATTR_NAME = re.compile(r'([^\s=/>]+)\s*(?:=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+))?')
+RE_ENTITY = re.compile(r'&(#[0-9]+;|#[xX][0-9a-fA-F]+;|[a-zA-Z][a-zA-Z0-9]*;)?')
+
+VOID_TAGS = frozenset({'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                       'param', 'source', 'track', 'wbr'})
+# Tags that libxml2 closes, moves or treats as raw text differently from html.parser
+UNSAFE_TAGS = frozenset({'html', 'head', 'body', 'frameset', 'frame', 'p', 'pre', 'listing', 'xmp', 'plaintext',
+                         'table', 'caption', 'colgroup', 'col', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th',
+                         'form', 'fieldset', 'legend', 'dl', 'dt', 'dd', 'select', 'option', 'optgroup',
+                         'address', 'dir', 'menu', 'center', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'button',
+                         'script', 'style', 'title', 'textarea', 'noscript', 'noembed', 'noframes', 'iframe',
+                         'object', 'applet', 'image', 'isindex', 'nobr', 'template',
+                         'embed', 'source', 'track', 'wbr'})
+# Tags that libxml2 refuses to nest inside themselves
+SELF_CLOSING_TAGS = frozenset({'a', 'li'})
+
+# Fields longer than this are scanned for sync spans without building a tree
+LARGE_FIELD = 16384
+# Tags in the subset of HTML where the scan and html.parser agree. Anything
+# else starting with < and a letter, slash, ! or ? makes the scan give up.
+RE_SCAN = re.compile(r'''
+    <(?P<start>[a-zA-Z][-.a-zA-Z0-9:_]*)
+        (?:\s+[^\s"'>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*\s*(?P<close>/?)>
+    |</(?P<end>[a-zA-Z][-.a-zA-Z0-9:_]*)\s*>
+    |<[a-zA-Z/!?]
+''', re.VERBOSE)
+# Tags html.parser treats as raw text
+RAW_TEXT_TAGS = frozenset({'script', 'style'})
+
+_backend = 'html.parser'
+
+
+def set_backend(name: str) -> str:
+    '''
+    Select the parser used by parse(). Return the backend actually in use,
+    falling back to 'html.parser' when lxml is not installed.
+    '''
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown parser backend')
+    if name == 'lxml' and not HAS_LXML:
+        name = 'html.parser'
+    _backend = name
+    return _backend
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def is_lxml_safe(text: str) -> bool:
+    '''
+    Return True if lxml builds the same tree as html.parser for the text.
+
+    Only well nested markup made of tags that libxml2 does not restructure
+    qualifies. Anything else is left to the reference parser.
+    '''
+    if '\r' in text:
+        return False  # libxml2 normalizes line endings
+    for m in RE_ENTITY.finditer(text):
+        entity = m.group(1)
+        if entity is None or (entity[0] != '#' and entity not in HTML5_ENTITIES):
+            return False
+
+    stack = []
+    for m in RE_TAG.finditer(text):
+        if m.group(2) is None:
+            return False  # comment, doctype, cdata or processing instruction
+        closing, tag, attrs = m.group(1), m.group(2).lower(), m.group(3)
+        if tag in UNSAFE_TAGS:
+            return False
+        if closing:
+            if tag in VOID_TAGS or len(stack) == 0 or stack.pop() != tag:
+                return False
+            continue
+        names = [a.lower() for a in RE_ATTR_NAME.findall(attrs)]
+        if len(names) != len(set(names)):
+            return False
+        if attrs.endswith('/'):
+            return False  # html.parser may nest the following content
+        if tag in VOID_TAGS:
+            continue
+        if tag in SELF_CLOSING_TAGS and tag in stack:
+            return False
+        stack.append(tag)
+    return len(stack) == 0
+
+
+def _parse_lxml(text: str) -> BeautifulSoup:
+    bs = BeautifulSoup(text, 'lxml')
+
+    # Unwrap the implied <html><head><body> so that top level elements of the
+    # field are top level elements of the soup, as with html.parser.
+    if bs.html is not None:
+        html = bs.html.extract()
+        for part in (html.head, html.body):
+            if part is None:
+                continue
+            for child in list(part.contents):
+                bs.append(child.extract())
+
+    # lxml drops leading whitespace of the fragment
+    stripped = text.lstrip(BeautifulSoup.ASCII_SPACES)
+    if len(stripped) != len(text):
+        lead = text[:len(text) - len(stripped)]
+        first = bs.contents[0] if len(bs.contents) > 0 else None
+        if isinstance(first, str):
+            lead += first
+        # html.parser collapses strings made of ASCII whitespace only
+        if lead.strip(BeautifulSoup.ASCII_SPACES) == '':
+            lead = '\n' if '\n' in lead else ' '
+        if isinstance(first, str):
+            first.replace_with(lead)
+        else:
+            bs.insert(0, lead)
+    return bs
+
+
+def parse(text: str) -> BeautifulSoup:
+    if _backend == 'lxml' and is_lxml_safe(text):
+        return _parse_lxml(text)
+    return BeautifulSoup(text, 'html.parser')
+
+
+def serialize(bs: BeautifulSoup) -> str:
+    return bs.encode(formatter='html5').decode('utf-8')
+
+
+def _serialize_node(node: PageElement) -> str:
+    return node.decode(formatter='html5') if isinstance(node, Tag) else node.output_ready(formatter='html5')
+
+
+def _element_end(text: str, start: re.Match) -> int:
+    # End of the element opened by the start tag, counting nested tags of the same name
+    name = start.group(2).lower()
+    if start.group(3).endswith('/'):
+        return start.end()
+    depth = 1
+    for m in RE_TAG.finditer(text, start.end()):
+        if m.group(2) is None or m.group(2).lower() != name:
+            continue
+        if m.group(1) == '/':
+            depth -= 1
+            if depth == 0:
+                return m.end()
+        elif not m.group(3).endswith('/'):
+            depth += 1
+    return len(text)
+
+
+def _find_element(text: str, pos: int, element: Tag) -> tuple[int, int] | None:
+    # Source region of the element at or after pos
+    expected = element.decode(formatter='html5')
+    values = [v for value in element.attrs.values()
+              for v in (value if isinstance(value, list) else [value])]
+    for m in RE_TAG.finditer(text, pos):
+        if m.group(1) != '' or m.group(2) is None or m.group(2).lower() != element.name:
+            continue
+        if any(v not in m.group(3) for v in values):
+            continue
+        end = _element_end(text, m)
+        if serialize(parse(text[m.start():end])) == expected:
+            return m.start(), end
+    return None
+
+
+def element_html(name: str, attrs: dict, contents: str) -> str:
+    '''
+    Serialize an element with the given attributes around already serialized contents.
+    '''
+    end = f'</{name}>'
+    return Tag(name=name, attrs=attrs).decode(formatter='html5')[:-len(end)] + contents + end
+
+
+def replace_elements(text: str, bs: BeautifulSoup, replacements: Sequence[tuple[Tag, Tag | str]]) -> str:
+    '''
+    Replace top level elements of bs, which was parsed from text, and return the new text.
+    Replacements are elements or their serialized HTML. The tree is not modified.
+
+    Only source regions of the replaced elements are rewritten, the rest of the
+    text is kept byte for byte. Falls back to serializing the whole tree if the
+    regions cannot be located.
+    '''
+    regions = []
+    pos = 0
+    for old, _ in replacements:
+        region = _find_element(text, pos, old)
+        if region is None:
+            break
+        regions.append(region)
+        pos = region[1]
+
+    # Serialized replacements are never parsed, the tree is serialized child by child instead
+    replaced = {id(old): new if isinstance(new, str) else new.decode(formatter='html5') for old, new in replacements}
+    parts = []
+    for child in bs.contents:
+        new = replaced.get(id(child))
+        parts.append(_serialize_node(child) if new is None else new)  # an empty replacement removes the element
+    full = ''.join(parts)
+    if len(regions) != len(replacements):
+        return full
+
+    out = []
+    pos = 0
+    for (start, end), (old, _) in zip(regions, replacements):
+        out += [text[pos:start], replaced[id(old)]]
+        pos = end
+    out.append(text[pos:])
+    spliced = ''.join(out)
+
+    # The spliced text must parse to the same tree
+    if serialize(parse(spliced)) != full:
+        return full
+    return spliced
+
+
+class Located(NamedTuple):
+    element: Tag  # parsed from its source region alone
+    start: int
+    end: int
+
+
+def locate_sync_spans(text: str) -> list[Located] | None:
+    '''
+    Find top level sync spans of a large field without parsing the rest of it.
+
+    Only tags are visited, text runs and attribute values are skipped by a
+    single regex, and tags are nested exactly as html.parser nests them (see
+    index.SpanScanner). Return None for small fields and for markup outside
+    the supported subset, which must be parsed as a whole.
+    '''
+    if len(text) <= LARGE_FIELD:
+        return None
+    opened: list[str] = []
+    closed: list[str] = []  # void elements closed on their start tag
+    regions = []
+    span_start = None
+    for m in RE_SCAN.finditer(text):
+        name = m.group('start')
+        if name is not None:
+            name = name.lower()
+            if name in RAW_TEXT_TAGS:
+                return None
+            self_closing = m.group('close') == '/'
+            if len(opened) == 0 and name == 'span' and 'sync' in m.group():
+                span_start = m.start()
+            if span_start is not None and self_closing and name in closed:
+                return None  # nested differently when the span is parsed alone
+            if name in VOID_TAGS and not self_closing:
+                closed.append(name)
+            else:
+                opened.append(name)
+            if not self_closing:
+                continue
+        else:
+            name = m.group('end')
+            if name is None:
+                return None
+            name = name.lower()
+        # End tag, or the end of a self-closing start tag
+        if name in closed:
+            closed.remove(name)
+            continue
+        for i in range(len(opened) - 1, -1, -1):
+            if opened[i] == name:
+                del opened[i:]
+                break
+        if span_start is not None and len(opened) == 0:
+            regions.append((span_start, m.end()))
+            span_start = None
+    if span_start is not None:
+        regions.append((span_start, len(text)))
+
+    located = []
+    for start, end in regions:
+        bs = parse(text[start:end])
+        element = bs.contents[0] if len(bs.contents) == 1 else None
+        if not isinstance(element, Tag):
+            return None
+        if 'sync' in element.get('class', ()):
+            located.append(Located(element, start, end))
+    return located
+
+
+def splice(text: str, replacements: Sequence[tuple[Located, str]]) -> str:
+    '''
+    Replace located elements by serialized HTML, keeping the rest of the text as it is.
+    '''
+    out = []
+    pos = 0
+    for located, new in sorted(replacements, key=lambda replacement: replacement[0].start):
+        out += [text[pos:located.start], new]
+        pos = located.end
+    out.append(text[pos:])
+    return ''.join(out)
+
+
+class SyncSpans():
+    '''
+    Top level sync spans of a field. Large fields are scanned with
+    locate_sync_spans() instead of being parsed as a whole when possible.
+    '''
+    def __init__(self, text: str):
+        self.text = text
+        self.located = locate_sync_spans(text)
+        if self.located is None:
+            self.bs = parse(text)
+            self.spans: list[Tag] = self.bs.find_all('span', {'class': 'sync'}, recursive=False)
+        else:
+            self.bs = None
+            self.spans = [located.element for located in self.located]
+
+    def replace(self, replacements: Sequence[tuple[Tag, Tag | str]]) -> str:
+        '''
+        Replace some of the spans and return the new text, see replace_elements().
+        '''
+        if self.located is None:
+            return replace_elements(self.text, self.bs, replacements)
+        regions = {id(located.element): located for located in self.located}
+        return splice(self.text, [(regions[id(old)], new if isinstance(new, str) else new.decode(formatter='html5'))
+                                  for old, new in replacements])
@@ -0,0 +1,231 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import re
+import time
+from copy import copy
+from html.parser import HTMLParser
+from typing import Callable, NamedTuple, Sequence
+
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+from bs4 import BeautifulSoup
+
+from . import HAS_AQT, bidir, reference, unidir
+
+if HAS_AQT:
+    from aqt.addons import AddonManager
+    logger = AddonManager.get_logger(__name__)
+else:
+    logger = logging.getLogger(__name__)
+
+SyncCb = Callable[[Collection, Note, int], bool]
+
+
+class Mismatch(NamedTuple):
+    nid: NoteId
+    field_idx: int
+    reference: str
+    fast: str
+    kind: str = 'unidir'  # or 'bidir'
+
+
+class Report():
+    '''
+    Result of running the fast path and the reference implementation side by side.
+    '''
+    def __init__(self):
+        self.fields = 0
+        self.fast_time = 0.0
+        self.reference_time = 0.0
+        self.mismatches: list[Mismatch] = []
+
+    @property
+    def speedup(self) -> float:
+        return self.reference_time / self.fast_time if self.fast_time > 0 else 1.0
+
+    def __str__(self) -> str:
+        return (f'{self.fields} fields, {len(self.mismatches)} mismatches, '
+                f'fast {self.fast_time * 1000:.1f} ms, reference {self.reference_time * 1000:.1f} ms, '
+                f'speedup {self.speedup:.2f}x')
+
+
+class Capture():
+    '''
+    A collection whose note writes are recorded instead of saved, so both
+    implementations sync the same stored notes.
+    '''
+    def __init__(self, col: Collection):
+        self.col = col
+        self.written: dict[NoteId, list[str]] = {}
+
+    def __getattr__(self, name: str):
+        return getattr(self.col, name)
+
+    def update_note(self, note: Note, **kwargs):
+        self.written[note.id] = list(note.fields)
+
+    def update_notes(self, notes: Sequence[Note], **kwargs):
+        for note in notes:
+            self.update_note(note)
+
+
+class SpanEnd(HTMLParser):
+    '''
+    Find the end of the span a text starts with. Only span tags are counted,
+    tokenized by the same parser as BeautifulSoup's html.parser builder.
+    '''
+    def __init__(self, text: str):
+        super().__init__(convert_charrefs=False)
+        self.text = text
+        self.lines = [0] + [m.end() for m in re.finditer('\n', text)]
+        self.depth = 0
+        self.end = len(text)  # closed by the end of the field
+        self.done = False
+        self.feed(text)
+
+    def position(self) -> int:
+        line, column = self.getpos()
+        return self.lines[line - 1] + column
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag == 'span' and not self.done:
+            self.depth += 1
+
+    def handle_startendtag(self, tag: str, attrs: list):
+        if tag == 'span' and not self.done and self.depth == 0:
+            self.end = self.position() + len(self.get_starttag_text())
+            self.done = True
+
+    def handle_endtag(self, tag: str):
+        if tag == 'span' and not self.done and self.depth > 0:
+            self.depth -= 1
+            if self.depth == 0:
+                self.end = self.text.index('>', self.position()) + 1
+                self.done = True
+
+
+def _top_spans(text: str) -> list:
+    return BeautifulSoup(text, 'html.parser').find_all('span', {'class': 'sync'}, recursive=False)
+
+
+def outside_spans(text: str) -> list[str]:
+    '''
+    Return the source text around the top level sync spans, byte for byte.
+    '''
+    lines = [0] + [m.end() for m in re.finditer('\n', text)]
+    out = []
+    pos = 0
+    for span in _top_spans(text):
+        start = lines[span.sourceline - 1] + span.sourcepos
+        out.append(text[pos:start])
+        pos = start + SpanEnd(text[start:]).end
+    out.append(text[pos:])
+    return out
+
+
+def span_contents(text: str, original: str) -> list[str]:
+    '''
+    Return the top level sync spans serialized as parsed. Stamps only tell the
+    fast path what to skip and sids not in the original text are random, both
+    are left out.
+    '''
+    known = {span.get('sid') for span in _top_spans(original)}
+    out = []
+    for span in _top_spans(text):
+        span = copy(span)
+        if span.has_attr('stamp'):
+            del span['stamp']
+        if span.has_attr('sid') and span['sid'] not in known:
+            span['sid'] = ''
+        out.append(span.decode(formatter='html5'))
+    return out
+
+
+def same_field(original: str, ref: str, fast: str) -> bool:
+    '''
+    Whether the fast path left or wrote the field as the reference did. Sync
+    spans are compared as parsed, the text around them must be kept as it is.
+    '''
+    if ref == original:
+        return fast == original
+    return span_contents(fast, original) == span_contents(ref, original) and \
+        outside_spans(fast) == outside_spans(original)
+
+
+def _copy_note(note: Note) -> Note:
+    copied = copy(note)
+    copied.fields = list(note.fields)
+    return copied
+
+
+def _run(sync_cb: SyncCb, col: Collection, note: Note, field_idx: int) -> tuple[dict[NoteId, list[str]], float]:
+    # The note and the collection are left as they are, writes are only recorded
+    capture = Capture(col)
+    copied = _copy_note(note)
+    started = time.perf_counter()
+    if sync_cb(capture, copied, field_idx):
+        capture.written.setdefault(note.id, copied.fields)
+    return capture.written, time.perf_counter() - started
+
+
+def _upload_all(sids: Sequence[str]) -> dict[str, str]:
+    return {sid: 'Upload' for sid in sids}
+
+
+IMPLEMENTATIONS: dict[str, tuple[SyncCb, SyncCb]] = {  # kind -> reference, fast
+    'unidir': (reference.render_field, unidir.render_field),
+    'bidir': (lambda col, note, idx: reference.sync_bidir_field(col, note, idx, _upload_all),
+              lambda col, note, idx: bidir.sync_field(col, note, idx, resolve_cb=_upload_all)),
+}
+
+
+def compare_field(col: Collection, note: Note, field_idx: int, report: Report) -> list[Mismatch]:
+    '''
+    Sync the field with the fast path and the reference implementation, unidir
+    spans first and bidir spans then, conflicts being uploaded. Neither the
+    note nor the collection is changed.
+    '''
+    report.fields += 1
+    mismatches = []
+    for kind, (reference_cb, fast_cb) in IMPLEMENTATIONS.items():
+        ref, reference_time = _run(reference_cb, col, note, field_idx)
+        fast, fast_time = _run(fast_cb, col, note, field_idx)
+        report.reference_time += reference_time
+        report.fast_time += fast_time
+        for nid in sorted(set(ref) | set(fast)):
+            original = note.fields if nid == note.id else col.get_note(nid).fields
+            for idx, text in enumerate(original):
+                ref_text = ref.get(nid, original)[idx]
+                fast_text = fast.get(nid, original)[idx]
+                if not same_field(text, ref_text, fast_text):
+                    mismatches.append(Mismatch(nid, idx, ref_text, fast_text, kind))
+                    logger.warning(f'shadow {kind} mismatch in note {nid}, field {idx}')
+    report.mismatches += mismatches
+    return mismatches
+
+
+def compare_notes(col: Collection, nids: Sequence[NoteId]) -> Report:
+    report = Report()
+    for nid in nids:
+        note = col.get_note(nid)
+        for field_idx in range(len(note.fields)):
+            compare_field(col, note, field_idx, report)
+    return report
+
+
+# Comparisons made in shadow mode during the session
+session = Report()
@@ -0,0 +1,342 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Reference implementation of unidir and bidir syncing for the shadow mode, see
+# oracle.py. Frozen in the plain form the add-on started with: every field is
+# parsed with html.parser and serialized as a whole, nothing is cached and
+# notes are read from the collection every time. Only changes of behaviour are
+# carried over here, never optimizations, and nothing is shared with the
+# modules it checks.
+
+import os
+import re
+from copy import copy
+from random import randrange
+from typing import Callable, NamedTuple, Sequence
+
+import anki.errors
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+from bs4 import BeautifulSoup, Tag
+
+ResolveCb = Callable[[Sequence[str]], dict[str, str]]
+
+TOKENS = [
+    ('STARTIF', r'{{#.*?}}'),
+    ('ENDIF', r'{{/.*?}}'),
+    ('FIELD', r'{{.*?}}'),
+    ('TEXT', r'.'),
+]
+RE_TOKENS = re.compile('|'.join(f'(?P<{kind}>{value})' for kind, value in TOKENS), re.DOTALL)
+RE_FIELD = re.compile(r'{{(?P<field>[^:]+?)(?P<type>:\w*)?}}')
+FIELD_TYPES = {
+    ':cloze': 'FIELD_CLOZE',
+    ':cloze_overlapping': 'FIELD_CLOZE_OVERLAPPING',
+    ':assumptions': 'FIELD_ASSUMPTIONS',
+    ':with_im_eq_hint': 'FIELD_IM_EQ_HINT',
+}
+
+
+def _innermost(opener: str, closer: str) -> re.Pattern:
+    # Delimited text without nested delimiters, an optional ::hint included
+    inner = f'(?:(?!{opener}|{closer}).)*?'
+    return re.compile(f'{opener}({inner})(?:::{inner})?{closer}', re.DOTALL)
+
+
+RE_STRIP = {
+    'FIELD_CLOZE': _innermost(r'\{\{c\d+::', r'\}\}'),
+    'FIELD_CLOZE_OVERLAPPING': _innermost(r'\[\[oc\d+::', r'\]\]'),
+    'FIELD_ASSUMPTIONS': _innermost(r'\[\[', r'\]\]'),
+}
+
+
+class Token(NamedTuple):
+    type: str
+    value: str
+
+
+def tokenize(template: str) -> list[Token]:
+    tokens = []
+    text = ''
+    for m in RE_TOKENS.finditer(template):
+        kind = m.lastgroup
+        value = m.group()
+
+        if kind != 'TEXT' and len(text) > 0:
+            tokens.append(Token('TEXT', text))
+            text = ''
+
+        if kind in ('STARTIF', 'ENDIF'):
+            tokens.append(Token(kind, value[3:-2]))
+        elif kind == 'FIELD':
+            m = RE_FIELD.fullmatch(value)
+            tokens.append(Token(FIELD_TYPES.get(m.group('type'), 'FIELD_NORMAL'), m.group('field')))
+        elif kind == 'TEXT':
+            text += value
+
+    if len(text) > 0:
+        tokens.append(Token('TEXT', text))
+    return tokens
+
+
+def strip(text: str, field_type: str) -> str:
+    '''
+    Strip the text as the template field type does. Nested clozes and hints
+    are stripped from the innermost out until nothing changes.
+    '''
+    if field_type == 'FIELD_IM_EQ_HINT':
+        return text.split('::', 1)[0]
+    if field_type not in RE_STRIP:
+        return text
+    while True:
+        stripped = RE_STRIP[field_type].sub(r'\1', text)
+        if stripped == text:
+            return text
+        text = stripped
+
+
+def parse_fields(value: str, names: Sequence[str]) -> list[str]:
+    # Names containing spaces are matched greedily
+    words = value.split()
+    fields = []
+    i = 0
+    while i < len(words):
+        for j in range(len(words), i, -1):
+            if ' '.join(words[i:j]) in names:
+                fields.append(' '.join(words[i:j]))
+                i = j
+                break
+        else:
+            raise ValueError('Unknown field')
+    return fields
+
+
+class Fetcher():
+    def __init__(self, this_note: Note, other_note: Note, fields: str | None = None):
+        self.this_note = this_note
+        self.other_note = other_note
+        notetype = other_note.note_type()
+        try:
+            with open(os.path.join(os.path.dirname(__file__),
+                                   f'./user_files/templates/{notetype["name"]}.html'), 'r') as f:
+                self.tokens = tokenize(f.read())
+        except IOError:
+            raise ValueError('Unknown model')
+        names = [field['name'] for field in notetype['flds']]
+        self.fields = None if fields is None else parse_fields(fields, names)
+
+    def __check_cycles(self, text: str) -> str:
+        bs = BeautifulSoup(text, 'html.parser')
+        for span in bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False):
+            if span['note'] == str(self.this_note.id):
+                raise ValueError('Cycle detected')
+        return text
+
+    def __fetch_field(self, field: str, field_type: str) -> str:
+        return self.__check_cycles(strip(self.other_note[field], field_type))
+
+    def fetch(self) -> BeautifulSoup:
+        out = '\n'
+        if self.fields is not None:
+            # Fields are stripped as in the first place the template shows them
+            field_types = {}
+            for token in self.tokens:
+                if token.type.startswith('FIELD_'):
+                    field_types.setdefault(token.value, token.type)
+            for field in self.fields:
+                out += f'<div>{self.__fetch_field(field, field_types.get(field, "FIELD_NORMAL"))}</div>\n'
+            return BeautifulSoup(out, 'html.parser')
+
+        skip = ''
+        for token in self.tokens:
+            if skip != '' and (token.type != 'ENDIF' or token.value != skip):
+                continue
+            if token.type == 'STARTIF':
+                if self.__fetch_field(token.value, 'FIELD_NORMAL') == '':
+                    skip = token.value
+            elif token.type == 'ENDIF':
+                skip = ''
+            elif token.type == 'TEXT':
+                out += token.value
+            else:
+                out += self.__fetch_field(token.value, token.type)
+        return BeautifulSoup(out, 'html.parser')
+
+
+def render_field(col: Collection, this_note: Note, field_idx: int) -> bool:
+    '''
+    Render unidir spans of the field in memory, the note is not saved.
+    '''
+    if field_idx < 0 or field_idx >= len(this_note.fields):
+        return False  # should not happen
+
+    changed = False
+    bs = BeautifulSoup(this_note.fields[field_idx], 'html.parser')
+    # Only top spans are synced, transitive references are not propagated
+    for span in bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False):
+        span_new = copy(span)
+        span_new.clear()
+        # Stamps only tell the fast path what it can skip
+        if span_new.has_attr('stamp'):
+            del span_new['stamp']
+        try:
+            other_note = col.get_note(int(span['note']))
+            span_new.append(Fetcher(this_note, other_note, span.get('fields')).fetch())
+        except (ValueError, anki.errors.NotFoundError) as e:
+            div = bs.new_tag('div')
+            if str(e) in {'Unknown model', 'Unknown field', 'Cycle detected'}:
+                div.string = str(e)
+            else:
+                div.string = 'Invalid note ID'
+            span_new.append(div)
+
+        if span != span_new:
+            span.replace_with(span_new)
+            changed = True
+
+    if changed:
+        this_note.fields[field_idx] = bs.encode(formatter='html5').decode('utf-8')
+    return changed
+
+
+def generate_sid(col: Collection, note: Note, field_idx: int) -> str:
+    def generate_sid_internal():
+        return f'{note.id}_{field_idx}_{randrange(0, 10000):04}'
+    sid = generate_sid_internal()
+    while len(col.find_notes('"*:re:' + f'sid="{re.escape(sid)}"'.replace('"', '\\"') + '"')) > 0:
+        sid = generate_sid_internal()
+    return sid
+
+
+def top_spans(text: str, sid: str) -> list[Tag]:
+    bs = BeautifulSoup(text, 'html.parser')
+    return bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
+
+
+def revision(span: Tag) -> int:
+    rev = span.get('rev', '0')
+    return int(rev) if rev.isdigit() else 0
+
+
+def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: str) -> bool:
+    if len(nids) <= 1:
+        return True
+
+    first_span = None
+    for nid in nids:
+        for field_val in col.get_note(nid).fields:
+            for span in top_spans(field_val, sid):
+                if first_span is None:
+                    first_span = span
+                elif first_span != span:
+                    return False
+    return True
+
+
+def upload_note(note: Note, span: Tag) -> bool:
+    changed = False
+    for field_idx, field_val in enumerate(note.fields):
+        bs = BeautifulSoup(field_val, 'html.parser')
+        spans = bs.find_all('span', {'class': 'sync', 'sid': span['sid']}, recursive=False)
+        if all(other_span == span for other_span in spans):
+            continue
+        for other_span in spans:
+            other_span.replace_with(copy(span))
+        note.fields[field_idx] = bs.encode(formatter='html5').decode('utf-8')
+        changed = True
+    return changed
+
+
+def sync_bidir_field(col: Collection, this_note: Note, field_idx: int, resolve_cb: ResolveCb) -> bool:
+    '''
+    Sync bidir spans of a field, writing the changed notes. Conflicting sids
+    are resolved by a single call of resolve_cb, sids it leaves out are skipped.
+    '''
+    if this_note.id == 0:
+        return False  # the card is being created
+    if field_idx < 0 or field_idx >= len(this_note.fields):
+        return False  # should not happen
+
+    bs = BeautifulSoup(this_note.fields[field_idx], 'html.parser')
+    # Only top spans are synced, transitive references are not propagated
+    spans = bs.find_all('span', {'class': 'sync', 'note': False}, recursive=False)
+    changed = False
+    for span in spans:
+        if not span.has_attr('sid'):
+            span['sid'] = generate_sid(col, this_note, field_idx)
+            changed = True
+
+    pending = {}
+    for span in spans:
+        pending.setdefault(span['sid'], []).append(span)
+
+    # Copies with a higher revision win without asking, empty spans are always downloaded
+    actions = {}
+    peers = {}
+    for sid, sid_spans in pending.items():
+        nids = col.find_notes('"*:re:' + f'sid="{re.escape(sid)}"'.replace('"', '\\"') + '"')
+        if are_spans_coherent(col, nids, sid):
+            continue
+        others = {}
+        for nid in nids:
+            if nid == this_note.id:
+                continue
+            revs = [revision(other_span) for field_val in col.get_note(nid).fields
+                    for other_span in top_spans(field_val, sid)]
+            if len(revs) > 0:
+                others[nid] = max(revs)
+        peers[sid] = others
+        rev = max(revision(span) for span in sid_spans)
+        newest = [span for span in sid_spans if revision(span) == rev]
+        if rev > max(others.values(), default=-1) and all(span == newest[0] for span in newest):
+            actions[sid] = 'Propagate'
+        elif len(others) > 0 and (rev < max(others.values()) or all(len(span.contents) == 0 for span in sid_spans)):
+            actions[sid] = 'Download'
+    conflicts = [sid for sid in peers if sid not in actions]
+    if len(conflicts) > 0:
+        answers = resolve_cb(conflicts)
+        actions.update({sid: answers.get(sid, 'Skip') for sid in conflicts})
+
+    written: dict[NoteId, Note] = {}
+    for sid, others in peers.items():
+        sid_spans = pending[sid]
+        if actions[sid] in ('Upload', 'Propagate'):
+            source = max((span for span in sid_spans if len(span.contents) > 0),
+                         key=revision, default=sid_spans[0])
+            if actions[sid] == 'Upload':
+                source = copy(source)
+                source['rev'] = str(max([revision(span) for span in sid_spans] + list(others.values())) + 1)
+                source['origin'] = str(this_note.id)
+            for nid, other_rev in others.items():
+                # Notes sharing several sids with this one get all of them
+                note = written.get(nid) or col.get_note(nid)
+                if other_rev <= revision(source) and upload_note(note, source):
+                    written[nid] = note
+        elif actions[sid] == 'Download':
+            nid = max(others, key=others.get)
+            source = next(span for field_val in col.get_note(nid).fields for span in top_spans(field_val, sid))
+        else:
+            continue
+        for span in sid_spans:
+            if span != source:
+                span.replace_with(copy(source))
+                changed = True
+
+    if changed:
+        this_note.fields[field_idx] = bs.encode(formatter='html5').decode('utf-8')
+        written[this_note.id] = this_note
+    if len(written) > 0:
+        col.update_notes(list(written.values()))
+    return len(written) > 0
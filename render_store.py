@@ -0,0 +1,101 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 20000
+FLUSH_EVERY = 500  # new entries written at once
+
+SQL_CREATE = '''
+create table if not exists blocks (
+    key text primary key,  -- Fetcher.stamp(): note type, selected fields and source note content
+    html text not null,
+    refs text not null,  -- space separated note ids referenced by the block
+    used integer not null  -- seconds since the epoch, for eviction
+)'''
+SQL_GET = 'select html, refs from blocks where key = ?'
+SQL_PUT = 'insert or replace into blocks (key, html, refs, used) values (?, ?, ?, ?)'
+SQL_TOUCH = 'update blocks set used = ? where key = ?'
+SQL_EVICT = 'delete from blocks where key in (select key from blocks order by used limit ?)'
+
+
+class RenderStore():
+    '''
+    Rendered unidir blocks persisted in SQLite, so they survive restarts.
+
+    Blocks are keyed by a digest of everything they depend on, entries never
+    become stale and are only evicted, least recently used first, once there
+    are more than max_entries of them. Writes are buffered until flush().
+
+    The digest does not cover the code rendering the blocks. The store
+    outlives add-on updates, all entries are dropped when it is opened with
+    another version of the renderer than the one that wrote them.
+    '''
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES, version: int = 0):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        # Syncs run on background threads too
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('pragma journal_mode = wal')
+        self.db.execute('pragma synchronous = normal')
+        self.db.execute(SQL_CREATE)
+        if self.db.execute('pragma user_version').fetchone()[0] != version:
+            with self.db:
+                self.db.execute('delete from blocks')
+            self.db.execute(f'pragma user_version = {int(version)}')
+        self.pending: dict[str, tuple[str, str]] = {}
+        self.used: set[str] = set()
+
+    def get(self, key: str) -> tuple[str, frozenset[str]] | None:
+        with self.lock:
+            row = self.pending.get(key) or self.db.execute(SQL_GET, (key,)).fetchone()
+            if row is None:
+                return None
+            self.used.add(key)
+        html, refs = row
+        return html, frozenset(refs.split())
+
+    def put(self, key: str, html: str, refs: frozenset[str]):
+        with self.lock:
+            self.pending[key] = (html, ' '.join(sorted(refs)))
+        if len(self.pending) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write buffered entries and usage times, then evict the oldest entries over the limit.
+        '''
+        with self.lock:
+            if len(self.pending) == 0 and len(self.used) == 0:
+                return
+            now = int(time.time())
+            with self.db:
+                self.db.executemany(SQL_PUT, ((key, html, refs, now) for key, (html, refs) in self.pending.items()))
+                self.db.executemany(SQL_TOUCH, ((now, key) for key in self.used - self.pending.keys()))
+                excess = self.db.execute('select count() from blocks').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self.db.execute(SQL_EVICT, (excess,))
+            self.pending.clear()
+            self.used.clear()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,136 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from collections import deque
+from typing import Iterable
+
+import anki.errors
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+
+from . import bidir, cas, index, unidir
+
+LABEL = 'Sync notes'
+
+
+class Scheduler():
+    '''
+    Sync work left for idle time: notes whose unidir blocks may be stale and
+    sids whose copies may differ.
+
+    Work is done in slices bounded by a time budget. Only conflicts that need
+    no decision are resolved: bidir copies with equal revisions are left for
+    the editor to ask about.
+    '''
+    def __init__(self):
+        self.notes: deque[NoteId] = deque()
+        self.sids: deque[str] = deque()
+        self.__queued_notes: set[NoteId] = set()
+        self.__queued_sids: set[str] = set()
+        self.__step = 0  # undo step of the previous slices, see run()
+
+    def __bool__(self) -> bool:
+        return len(self.notes) > 0 or len(self.sids) > 0
+
+    def add_notes(self, nids: Iterable[NoteId]):
+        for nid in nids:
+            if nid not in self.__queued_notes:
+                self.__queued_notes.add(nid)
+                self.notes.append(nid)
+
+    def add_sids(self, sids: Iterable[str]):
+        for sid in sids:
+            if sid not in self.__queued_sids:
+                self.__queued_sids.add(sid)
+                self.sids.append(sid)
+
+    def add_changed(self, col: Collection, nids: Iterable[NoteId]):
+        '''
+        Queue the work following a change of the notes: their dependents and their sids.
+        '''
+        sync_index = index.get(col)
+        nids = list(nids)
+        self.add_notes(sync_index.dependents(nids))
+        for nid in nids:
+            entry = sync_index.entries.get(nid)
+            if entry is not None:
+                self.add_sids(entry.sids)
+
+    def fill(self, col: Collection):
+        '''
+        Queue every note with unidir blocks and every sid of the collection.
+        '''
+        sync_index = index.get(col)
+        self.add_notes(nid for nid, entry in sync_index.entries.items() if len(entry.notes) > 0)
+        self.add_sids(sync_index.sids)
+
+    def clear(self):
+        self.__init__()
+
+    def run(self, col: Collection, budget: float) -> list[NoteId]:
+        '''
+        Do pending work for about budget seconds and return the updated notes.
+
+        The writes of consecutive slices share a single undo step, a new one is
+        started when anything else was done meanwhile, see cas.UndoStep.
+        '''
+        deadline = time.perf_counter() + budget
+        undo = cas.UndoStep(self.__step, LABEL)
+        rendered: list[Note] = []
+        versions: dict[NoteId, cas.Version] = {}
+        updated: list[NoteId] = []
+        while len(self.notes) > 0 and time.perf_counter() < deadline:
+            nid = self.notes.popleft()
+            self.__queued_notes.discard(nid)
+            try:
+                note = col.get_note(nid)
+            except anki.errors.NotFoundError:
+                continue  # deleted meanwhile
+            versions[nid] = cas.version(note)
+            if unidir.render_note(col, note):
+                rendered.append(note)
+        if len(rendered) > 0:
+            # Notes edited meanwhile are rendered again in a later slice
+            conflicting = cas.write(col, rendered, versions, undo)
+            self.add_notes(conflicting)
+            skipped = set(conflicting)
+            updated += [note.id for note in rendered if note.id not in skipped]
+
+        while len(self.sids) > 0 and time.perf_counter() < deadline:
+            sid = self.sids.popleft()
+            self.__queued_sids.discard(sid)
+            nids = sorted(index.get(col).sids.get(sid, ()))
+            if bidir.are_spans_coherent(col, nids, sid):
+                continue
+            notes = [col.get_note(nid) for nid in nids]
+            versions = {note.id: cas.version(note) for note in notes}
+            fields = [(note, field_idx) for note in notes for field_idx, text in enumerate(note.fields)
+                      if sid in text]
+            try:
+                # Nobody is asked, copies of the same revision are skipped
+                if bidir.sync_fields(col, fields, lambda _: {}, versions, undo):
+                    updated += nids
+            except cas.ConflictError:
+                self.add_sids([sid])  # edited meanwhile, synced again in a later slice
+
+        if undo.target is not None:
+            undo.merge(col)
+            self.__step = undo.target
+        if len(updated) > 0:
+            index.invalidate(col)
+            # Blocks including the updated notes are stale now
+            self.add_changed(col, updated)
+        return updated
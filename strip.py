@@ -0,0 +1,132 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from enum import Flag, auto
+from typing import Iterable
+
+# Anki joins fields of a note with the same separator
+SEPARATOR = '\x1f'
+
+
+class Strip(Flag):
+    '''
+    Transforms applied to a field before it is copied to a sync block.
+
+    CLOZE:             {{c1::answer::hint}} -> answer
+    CLOZE_OVERLAPPING: [[oc1::answer::hint]] -> answer
+    ASSUMPTION_HINTS:  [[assumption::hint]] -> assumption
+    IM_EQ_HINTS:       text::hint -> text
+    '''
+    NONE = 0
+    CLOZE = auto()
+    CLOZE_OVERLAPPING = auto()
+    ASSUMPTION_HINTS = auto()
+    IM_EQ_HINTS = auto()
+
+
+OPENERS = {
+    Strip.CLOZE: r'\{\{c\d+::',
+    Strip.CLOZE_OVERLAPPING: r'\[\[oc\d+::',
+    Strip.ASSUMPTION_HINTS: r'\[\[',
+}
+CLOSERS = {
+    Strip.CLOZE: '}}',
+    Strip.CLOZE_OVERLAPPING: ']]',
+    Strip.ASSUMPTION_HINTS: ']]',
+}
+
+_re_cache: dict[Strip, re.Pattern] = {}
+
+
+def _tokens_re(flags: Strip) -> re.Pattern:
+    # Only delimiters of the requested transforms are tokens, the rest is text
+    if flags not in _re_cache:
+        tokens = [f'(?P<{kind.name}>{opener})' for kind, opener in OPENERS.items() if kind in flags]
+        closers = {re.escape(closer) for kind, closer in CLOSERS.items() if kind in flags}
+        tokens += [f'(?P<CLOSE>{"|".join(sorted(closers))})'] if len(closers) > 0 else []
+        tokens += [r'(?P<HINT>::)', f'(?P<SEPARATOR>{SEPARATOR})']
+        _re_cache[flags] = re.compile('|'.join(tokens))
+    return _re_cache[flags]
+
+
+def strip(text: str, flags: Strip) -> str:
+    '''
+    Apply all transforms in flags to the text in a single scan. Clozes can be nested.
+
+    Runs in linear time: every delimiter is visited once and every output
+    piece is removed at most once, regardless of nesting depth.
+    '''
+    if flags == Strip.NONE:
+        return text
+    re_tokens = _tokens_re(flags)
+    truncate_hints = Strip.IM_EQ_HINTS in flags
+
+    # Delimiters are emitted as they come and blanked once their frame is
+    # closed, so unclosed ones stay in the output without any rewinding.
+    # A frame is [closing delimiter, index of opener, index of hint separator].
+    out: list[str] = []
+    stack: list[list] = []
+    truncated = False
+
+    pos = 0
+    for m in re_tokens.finditer(text):
+        kind = m.lastgroup
+        start = m.start()
+        if start > pos and not truncated:
+            out.append(text[pos:start])
+        pos = m.end()
+
+        if kind == 'SEPARATOR':
+            stack.clear()
+            out.append(SEPARATOR)
+            truncated = False
+        elif truncated:
+            continue
+        elif kind == 'HINT':
+            if len(stack) > 0:
+                if stack[-1][2] is None:
+                    stack[-1][2] = len(out)
+            elif truncate_hints:
+                truncated = True
+                continue
+            out.append('::')
+        elif kind == 'CLOSE':
+            value = m.group()
+            if len(stack) > 0 and stack[-1][0] == value:
+                _, opener, hint = stack.pop()
+                if hint is not None:
+                    del out[hint:]
+                out[opener] = ''
+            else:
+                out.append(value)
+        else:
+            stack.append([CLOSERS[Strip[kind]], len(out), None])
+            out.append(m.group())
+
+    if not truncated:
+        out.append(text[pos:])
+    return ''.join(out)
+
+
+def strip_batch(texts: Iterable[str], flags: Strip) -> list[str]:
+    '''
+    Strip many fields at once. The fields are scanned together as a single
+    string, delimiters never match across field boundaries.
+    '''
+    texts = list(texts)
+    if len(texts) == 0:
+        return []
+    return strip(SEPARATOR.join(texts), flags).split(SEPARATOR)
@@ -0,0 +1,295 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from anki.collection import DeckIdLimit
+from anki.import_export_pb2 import ExportAnkiPackageOptions, ImportAnkiPackageOptions, ImportAnkiPackageRequest
+
+from . import batch, unidir
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+def test_sync_notes(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync">Shared</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = 'No sync'
+    col.add_note(n3, 0)
+
+    progress = []
+    result = batch.sync_notes(col, [n1.id, n2.id, n3.id], 'Sync notes', lambda i, n: progress.append((i, n)))
+    assert result.count == 2
+    assert progress == [(0, 4), (1, 4), (2, 4), (3, 4)]
+    assert col.undo_status().undo == 'Sync notes'
+
+    load_notes((n1, n2, n3))
+    assert 'sid="' in n1['Front']
+    assert 'Shared' in n2['Front']
+    # The rendered block includes the sid assigned in the same batch
+    assert 'sid="' in n2['Front']
+    assert n3['Front'] == 'No sync'
+
+    assert batch.sync_notes(col, [n1.id, n2.id, n3.id], 'Sync notes').count == 0
+
+
+def test_sync_notes_bidir(col):
+    basic = col.models.by_name('Basic')
+    notes = []
+    for front in ('<span class="sync" sid="1">Mine</span>', '<span class="sync" sid="1">Theirs</span>',
+                  '<span class="sync" sid="2">A</span>', '<span class="sync" sid="2">B</span>'):
+        note = col.new_note(basic)
+        note['Front'] = front
+        col.add_note(note, 0)
+        notes.append(note)
+
+    calls = []
+
+    def resolve_cb(sids):
+        calls.append(sorted(sids))
+        return {'1': 'Upload'}
+
+    # Copies outside of the selection are synced too
+    result = batch.sync_notes(col, [notes[0].id, notes[2].id], 'Sync notes', resolve_cb=resolve_cb)
+    assert calls == [['1', '2']]
+    assert result.count == 2
+    load_notes(notes)
+    uploaded = f'<span class="sync" origin="{notes[0].id}" rev="1" sid="1">Mine</span>'
+    assert notes[0]['Front'] == notes[1]['Front'] == uploaded
+    assert (notes[2]['Front'], notes[3]['Front']) == ('<span class="sync" sid="2">A</span>',
+                                                      '<span class="sync" sid="2">B</span>')
+
+
+def test_sync_notes_download_all_selected(col):
+    basic = col.models.by_name('Basic')
+    notes = []
+    for front in ('<span class="sync" sid="s1">one</span>', '<span class="sync" sid="s1">two</span>'):
+        note = col.new_note(basic)
+        note['Front'] = front
+        col.add_note(note, 0)
+        notes.append(note)
+
+    # No copy is left outside of the selection, the newest selected one is downloaded
+    result = batch.sync_notes(col, [note.id for note in notes], 'Sync notes', None,
+                              lambda sids: {sid: 'Download' for sid in sids})
+    assert result.count == 1
+    load_notes(notes)
+    assert notes[0]['Front'] == notes[1]['Front'] == '<span class="sync" sid="s1">one</span>'
+
+
+def test_sync_notes_read_once(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync">Shared</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    reads = []
+    get_note = col.get_note
+    monkeypatch.setattr(col, 'get_note', lambda nid: reads.append(nid) or get_note(nid))
+    result = batch.sync_notes(col, [n1.id, n2.id], 'Sync notes', resolve_cb=lambda _: {})
+    monkeypatch.undo()
+
+    # Assigning sids, rendering and syncing bidir spans share the notes read once
+    assert result.count == 2
+    assert sorted(reads) == [n1.id, n2.id]
+    load_notes((n1, n2))
+    sid = n1['Front'].split('sid="')[1].split('"')[0]
+    assert f'sid="{sid}"' in n2['Front']
+
+
+def test_imported_notes(col, tmp_path):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    path = str(tmp_path / 'notes.apkg')
+    col.export_anki_package(out_path=path, options=ExportAnkiPackageOptions(), limit=DeckIdLimit(1))
+
+    other = get_empty_col()
+    # Not imported, left alone although never sent to AnkiWeb either
+    n3 = other.new_note(other.models.by_name('Basic'))
+    n3['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    other.add_note(n3, 0)
+
+    result = other.import_anki_package(ImportAnkiPackageRequest(package_path=path, options=ImportAnkiPackageOptions()))
+    nids = batch.imported_notes(result.log)
+    assert sorted(nids) == [n1.id, n2.id]
+    assert batch.sync_notes(other, nids, 'Sync imported notes').count == 1
+    assert 'Front text' in other.get_note(n2.id)['Front']
+    assert other.get_note(n3.id)['Front'] == f'<span class="sync" note="{n1.id}"></span>'
+
+
+def test_sync_candidates(col):
+    basic = col.models.by_name('Basic')
+    nids = []
+    for front in ('<span class="sync" note="1"></span>', 'Plain', '<span class="sync">x</span>'):
+        note = col.new_note(basic)
+        note['Front'] = front
+        col.add_note(note, 0)
+        nids.append(note.id)
+    assert sorted(batch.sync_candidates(col, nids)) == [nids[0], nids[2]]
+    assert batch.sync_candidates(col, []) == []
+
+
+def test_update_dependents(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Old text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    unidir.sync_note(col, n2)
+
+    n1['Front'] = 'New text'
+    col.update_note(n1)
+    step = col.undo_status().last_step
+
+    assert batch.update_dependents(col, [n2.id], step).count == 1
+    assert 'New text' in col.get_note(n2.id)['Front']
+    assert batch.update_dependents(col, [n2.id], step).count == 0
+
+    # Undoing the edit undoes the propagation too
+    assert col.undo_status().last_step == step
+    col.undo()
+    assert col.get_note(n1.id)['Front'] == 'Old text'
+    assert 'Old text' in col.get_note(n2.id)['Front']
+
+
+def test_update_dependents_own_step(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Old text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    unidir.sync_note(col, n2)
+
+    n1['Front'] = 'New text'
+    col.update_note(n1)
+    step = col.undo_status().last_step
+    # Another change finished before the propagation ran
+    n3 = col.new_note(basic)
+    col.add_note(n3, 0)
+
+    assert batch.update_dependents(col, [n2.id], step).count == 1
+    assert col.undo_status().undo == 'Update synced notes'
+    col.undo()
+    assert 'Old text' in col.get_note(n2.id)['Front']
+    assert col.find_notes(f'nid:{n3.id}') == [n3.id]
+
+
+def test_sync_added_notes(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Source'
+    n1['Back'] = '<span class="sync" sid="1">Shared</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span><span class="sync">Own</span>'
+    n2['Back'] = '<span class="sync" sid="1"></span>'
+    col.add_note(n2, 0)
+    step = col.undo_status().last_step
+
+    assert batch.sync_added_notes(col, [(n2.id, step)]).count == 1
+    load_notes((n2,))
+    assert 'Source' in n2['Front']
+    assert '<span class="sync" sid="' in n2['Front']
+    assert n2['Back'] == '<span class="sync" sid="1">Shared</span>'
+    assert batch.sync_added_notes(col, [(n2.id, step)]).count == 0
+
+    # Undoing the addition undoes the sync too
+    assert col.undo_status().last_step == step
+    col.undo()
+    assert col.find_notes(f'nid:{n2.id}') == []
+
+
+def test_sync_added_notes_steps(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Source'
+    col.add_note(n1, 0)
+
+    added = []
+    for _ in range(2):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, 0)
+        added.append((note.id, col.undo_status().last_step))
+
+    assert batch.sync_added_notes(col, added).count == 2
+    # The first note is synced in a step of its own, the last one with its addition
+    assert col.undo_status().undo == 'Sync added notes'
+    col.undo()
+    assert col.get_note(added[0][0])['Front'] == f'<span class="sync" note="{n1.id}"></span>'
+    assert 'Source' in col.get_note(added[1][0])['Front']
+    col.undo()
+    assert col.find_notes(f'nid:{added[1][0]}') == []
+    assert col.find_notes(f'nid:{added[0][0]}') == [added[0][0]]
+
+
+def test_sync_added_notes_conflict(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" rev="1" sid="1">Theirs</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" rev="1" sid="1">Mine</span>'
+    col.add_note(n2, 0)
+    step = col.undo_status().last_step
+
+    asked = []
+
+    def resolve_cb(sids):
+        asked.append(list(sids))
+        return {sid: 'Download' for sid in sids}
+
+    batch.sync_added_notes(col, [(n2.id, step)], resolve_cb)
+    assert asked == [['1']]
+    load_notes((n2,))
+    assert 'Theirs' in n2['Front']
@@ -94,8 +94,8 @@ def test_upload_single(col):
     assert bidir.sync_field(col, n2, 0, MockPopup('Upload')) is True
     load_notes((n1, n2))
 
-    assert n1['Front'] == '<span class="sync" sid="1">New content</span>'
-    assert n2['Front'] == '<span class="sync" sid="1">New content</span>'
+    assert n1['Front'] == f'<span class="sync" origin="{n2.id}" rev="1" sid="1">New content</span>'
+    assert n2['Front'] == f'<span class="sync" origin="{n2.id}" rev="1" sid="1">New content</span>'
 
 
 def test_upload_multiple(col):
@@ -116,9 +116,9 @@ def test_upload_multiple(col):
     assert bidir.sync_field(col, n3, 0, MockPopup('Upload')) is True
     load_notes((n1, n2, n3))
 
-    assert n1['Front'] == '<span class="sync" sid="1">New content</span>'
-    assert n2['Front'] == '<span class="sync" sid="1">New content</span>'
-    assert n3['Front'] == '<span class="sync" sid="1">New content</span>'
+    assert n1['Front'] == f'<span class="sync" origin="{n3.id}" rev="1" sid="1">New content</span>'
+    assert n2['Front'] == f'<span class="sync" origin="{n3.id}" rev="1" sid="1">New content</span>'
+    assert n3['Front'] == f'<span class="sync" origin="{n3.id}" rev="1" sid="1">New content</span>'
 
 
 def test_download_different_ids(col):
@@ -378,8 +378,9 @@ def test_span_containing_html_elements_2(col):
     load_notes((n1, n2))
 
     assert popup.n_called() == 1
-    assert n1['Front'] == '<span class="sync" sid="1">Before <b>Original content</b> After</span>'
-    assert n2['Front'] == '<span class="sync" sid="1">Before <b>Original content</b> After</span>'
+    expected = f'<span class="sync" origin="{n1.id}" rev="1" sid="1">Before <b>Original content</b> After</span>'
+    assert n1['Front'] == expected
+    assert n2['Front'] == expected
 
 
 def test_field_excluded_from_unqualified_search(col):
@@ -399,6 +400,134 @@ def test_field_excluded_from_unqualified_search(col):
     assert n1['Back'] == '<span class="sync" sid="1">Original content</span>'
     assert n2['Back'] == '<span class="sync" sid="1">Original content</span>'
 
+
+def test_batched_conflicts(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original 1</span>'
+    n1['Back'] = '<span class="sync" sid="2">Original 2</span><span class="sync" sid="3">Original 3</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New 1</span><span class="sync" sid="2">New 2</span>'
+    n2['Back'] = '<span class="sync" sid="3">New 3</span>'
+    col.add_note(n2, 0)
+
+    calls = []
+
+    def resolve(sids):
+        calls.append(list(sids))
+        return {'1': 'Upload', '2': 'Download'}  # 3 is skipped
+
+    assert bidir.sync_note(col, n2, resolve) is True
+    load_notes((n1, n2))
+
+    assert calls == [['1', '2', '3']]
+    assert n1['Front'] == f'<span class="sync" origin="{n2.id}" rev="1" sid="1">New 1</span>'
+    assert n2['Front'] == (f'<span class="sync" origin="{n2.id}" rev="1" sid="1">New 1</span>'
+                           '<span class="sync" sid="2">Original 2</span>')
+    assert n1['Back'] == '<span class="sync" sid="2">Original 2</span><span class="sync" sid="3">Original 3</span>'
+    assert n2['Back'] == '<span class="sync" sid="3">New 3</span>'
+
+
+def test_batched_conflicts_cancelled(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New content</span><span class="sync"></span>'
+    col.add_note(n2, 0)
+
+    assert bidir.sync_fields(col, [(n1, 0), (n2, 0)], lambda _: {}) is True
+    load_notes((n1, n2))
+
+    assert n1['Front'] == '<span class="sync" sid="1">Original content</span>'
+    assert n2['Front'].startswith('<span class="sync" sid="1">New content</span><span class="sync" sid="')
+
+
+@pytest.mark.parametrize('rev1, rev2, expected', [
+    (2, 1, '<span class="sync" origin="1" rev="2" sid="1">Newer</span>'),
+    (1, 2, '<span class="sync" origin="2" rev="2" sid="1">Older</span>'),
+])
+def test_revisions_resolve_without_asking(col, rev1, rev2, expected):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = f'<span class="sync" origin="1" rev="{rev1}" sid="1">Newer</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" origin="2" rev="{rev2}" sid="1">Older</span>'
+    col.add_note(n2, 0)
+
+    popup = MockPopup('Download')
+
+    assert bidir.sync_field(col, n1, 0, popup) is True
+    load_notes((n1, n2))
+
+    assert popup.n_called() == 0
+    assert n1['Front'] == expected
+    assert n2['Front'] == expected
+
+
+def test_upload_increases_revision(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" origin="1" rev="3" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" origin="1" rev="3" sid="1">New content</span>'
+    col.add_note(n2, 0)
+
+    assert bidir.sync_field(col, n2, 0, MockPopup('Upload')) is True
+    load_notes((n1, n2))
+
+    assert n1['Front'] == n2['Front'] == f'<span class="sync" origin="{n2.id}" rev="4" sid="1">New content</span>'
+
+
+def test_upload_several_sids_to_one_note(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Old 1</span>'
+    n1['Back'] = '<span class="sync" sid="2">Old 2</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New 1</span><span class="sync" sid="2">New 2</span>'
+    col.add_note(n2, 0)
+
+    assert bidir.sync_field(col, n2, 0, MockPopup('Upload')) is True
+    load_notes((n1,))
+
+    assert 'New 1' in n1['Front']
+    assert 'New 2' in n1['Back']
+
+
+def test_upload_to_multiline_field(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Line\n<span class="sync" origin="1" rev="3" sid="1">\nOriginal content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" origin="1" rev="3" sid="1">New content</span>'
+    col.add_note(n2, 0)
+
+    assert sorted(col.find_notes(bidir.sid_search('1'))) == [n1.id, n2.id]
+    # The copy spanning several lines gets the new revision too
+    assert bidir.sync_field(col, n2, 0, MockPopup('Upload')) is True
+    load_notes((n1,))
+    assert n1['Front'] == f'Line\n<span class="sync" origin="{n2.id}" rev="4" sid="1">New content</span>'
+
+
 # TODO
 # def test_nested_spans():
 #     pass
@@ -0,0 +1,161 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import bidir, cas, index, scheduler
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    col = get_empty_col()
+    yield col
+    index.drop(col)
+
+
+def edit(col, nid, text):
+    # An edit made by the user while the note is synced
+    note = col.get_note(nid)
+    note['Front'] = text
+    col.update_note(note)
+
+
+def test_write(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'One'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = 'Two'
+    col.add_note(n2, 0)
+
+    notes = [col.get_note(n1.id), col.get_note(n2.id)]
+    versions = {note.id: cas.version(note) for note in notes}
+    for note in notes:
+        note['Back'] = 'Synced'
+    # Edited in the same second as read, told apart by its fields
+    edit(col, n2.id, 'Edited')
+
+    assert cas.write(col, notes, versions) == [n2.id]
+    load_notes((n1, n2))
+    assert n1['Back'] == 'Synced'
+    assert (n2['Front'], n2['Back']) == ('Edited', '')
+
+    with pytest.raises(cas.ConflictError):
+        cas.write_all(col, notes, versions)
+
+
+def test_write_tags(col):
+    n1 = col.new_note(col.models.by_name('Basic'))
+    n1['Front'] = 'One'
+    n1.tags = ['b', 'a']
+    col.add_note(n1, 0)
+
+    note = col.get_note(n1.id)
+    versions = {note.id: cas.version(note)}
+    assert cas.conflicts(col, versions) == []
+    note['Back'] = 'Synced'
+    # Tagged in the same second as read
+    tagged = col.get_note(n1.id)
+    tagged.tags.append('c')
+    col.update_note(tagged)
+
+    assert cas.write(col, [note], versions) == [n1.id]
+    load_notes((n1,))
+    assert (n1['Back'], n1.tags) == ('', ['a', 'b', 'c'])
+
+
+def test_update_retries(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'One'
+    col.add_note(n1, 0)
+
+    calls = []
+
+    def update_cb(col, note):
+        if len(calls) == 0:
+            edit(col, note.id, 'Edited')
+        calls.append(note['Front'])
+        note['Back'] = note['Front']
+        return True
+
+    assert cas.update(col, [n1.id], update_cb) == [n1.id]
+    assert calls == ['One', 'Edited']
+    load_notes((n1,))
+    assert (n1['Front'], n1['Back']) == ('Edited', 'Edited')
+
+    def always_edit(col, note):
+        edit(col, note.id, note['Front'] + '!')
+        note['Back'] = 'Synced'
+        return True
+
+    assert cas.update(col, [n1.id], always_edit, retries=1) == []
+    load_notes((n1,))
+    assert (n1['Front'], n1['Back']) == ('Edited!!', 'Edited')
+
+
+def test_bidir_conflict(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" rev="2" sid="1">New</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" rev="1" sid="1">Old</span>'
+    col.add_note(n2, 0)
+
+    note = col.get_note(n1.id)
+    versions = {note.id: cas.version(note)}
+    edit(col, n1.id, '<span class="sync" rev="3" sid="1">Newer</span>')
+    with pytest.raises(cas.ConflictError):
+        bidir.sync_note(col, note, lambda _: {}, versions)
+    load_notes((n1, n2))
+    assert n2['Front'] == '<span class="sync" rev="1" sid="1">Old</span>'
+
+
+def test_scheduler_requeues(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    render_note = scheduler.unidir.render_note
+
+    def render_edited(col, note):
+        monkeypatch.setattr(scheduler.unidir, 'render_note', render_note)
+        edit(col, note.id, note['Front'] + 'Typed')
+        return render_note(col, note)
+
+    monkeypatch.setattr(scheduler.unidir, 'render_note', render_edited)
+    work = scheduler.Scheduler()
+    work.add_notes([n2.id])
+    assert n2.id not in work.run(col, 1)
+    assert list(work.notes) == [n2.id]
+
+    work.run(col, 1)
+    load_notes((n2,))
+    assert n2['Front'].endswith('</span>Typed')
+    assert 'Front' in n2['Front']
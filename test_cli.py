@@ -0,0 +1,78 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+from anki.collection import Collection
+
+from . import cli
+from .test_utils import get_empty_col
+
+
+def make_collection() -> str:
+    col = get_empty_col()
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">old</span>'
+    col.add_note(n3, 0)
+
+    time.sleep(1)  # modification times have a resolution of seconds
+    n4 = col.new_note(basic)
+    n4['Front'] = '<span class="sync" sid="1">new</span>'
+    col.add_note(n4, 0)
+
+    path = col.path
+    col.close()
+    return path
+
+
+def fronts(path: str) -> list[str]:
+    col = Collection(path)
+    try:
+        return [col.get_note(nid)['Front'] for nid in sorted(col.find_notes(''))]
+    finally:
+        col.close()
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_sync_collections(jobs):
+    paths = [make_collection(), make_collection()]
+    results = cli.sync_collections(paths, jobs, 'newest')
+    assert [(r.path, r.notes, r.reconciled) for r in results] == [(path, 1, 1) for path in paths]
+    for path in paths:
+        front = fronts(path)
+        assert 'Front' in front[1]
+        # Both copies had revision 0, the newer one became revision 1
+        assert front[2] == front[3]
+        assert front[3].endswith(' rev="1" sid="1">new</span>')
+
+
+def test_main(capsys, tmp_path):
+    path = make_collection()
+    assert cli.main([path, str(tmp_path / 'missing' / 'collection.anki2')]) == 1
+    out, err = capsys.readouterr()
+    assert f'{path}: 1 notes updated, 0 sids reconciled' in out
+    assert 'missing' in err
+    assert '<span class="sync" sid="1">old</span>' in fronts(path)[2]
@@ -0,0 +1,187 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import index
+from .test_utils import get_empty_col
+
+
+@pytest.fixture
+def col():
+    col = get_empty_col()
+    yield col
+    index.drop(col)
+
+
+def add_basic(col, front: str, back: str = ''):
+    note = col.new_note(col.models.by_name('Basic'))
+    note['Front'] = front
+    note['Back'] = back
+    col.add_note(note, 0)
+    return note
+
+
+def test_scan_nesting():
+    # Nested the same way as by BeautifulSoup's html.parser builder
+    assert index.scan(['<b></b><span class="sync" note="1"></span>']).notes == {'1'}
+    assert index.scan(['<b><span class="sync" note="1"></span>']).notes == set()
+    assert index.scan(['<div><b></div><span class="sync" note="1"></span>']).notes == {'1'}
+    assert index.scan(['</b><span class="sync" note="1"></span>']).notes == {'1'}
+    assert index.scan(['<br><br/><span class="sync" note="1"></span>']).notes == set()
+    assert index.scan(['<span/><span class="a sync" note="1" note="2"/>']).notes == {'2'}
+    assert index.scan(['<script><span></script><span class="sync" sid></span>']).sids == {''}
+    assert index.scan(['<![foo[x]]><span class="sync" note="1"></span>']) == index.Entry(frozenset(), frozenset())
+
+
+def test_scan():
+    entry = index.scan([
+        '<span class="sync" note="1"></span> <div><span class="sync" note="2"></span></div>',
+        '<span class="sync" sid="1_0_0001">Content</span><span note="3"></span>',
+        'no spans',
+    ])
+    assert entry == index.Entry(frozenset({'1'}), frozenset({'1_0_0001'}))
+
+
+def test_report(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    n3 = add_basic(col, 'x', f'<span class="sync" note="{n1.id}"></span><span class="sync" sid="1">A</span>')
+    n4 = add_basic(col, '<span class="sync" sid="1">A</span>')
+    n5 = add_basic(col, '<span class="sync" sid="2">B</span>')
+
+    report = index.report(col, n1.id)
+    assert report.referencing == sorted([n2.id, n3.id])
+    assert report.peers == {}
+
+    assert index.report(col, n3.id) == index.SyncReport([], {'1': [n4.id]})
+    assert index.report(col, n4.id) == index.SyncReport([], {'1': [n3.id]})
+    assert index.report(col, n5.id) == index.SyncReport([], {'2': []})
+
+
+def test_refresh(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    assert index.report(col, n1.id).referencing == [n2.id]
+
+    n2['Front'] = 'No reference'
+    col.update_note(n2)
+    n3 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+
+    # Not refreshed until invalidated
+    assert index.report(col, n1.id).referencing == [n2.id]
+    index.invalidate(col)
+    assert index.report(col, n1.id).referencing == [n3.id]
+
+
+def test_remove_notes(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    n3 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    assert index.report(col, n1.id).referencing == [n2.id, n3.id]
+
+    col.remove_notes([n2.id])
+    assert index.report(col, n1.id).referencing == [n3.id]
+    assert n2.id not in index.get(col).entries
+
+
+def test_changed_notes(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    n3 = add_basic(col, f'<span class="sync" note="{n2.id}"></span>')
+    assert index.changed_notes(col) == []  # index built
+
+    n1['Front'] = 'Changed'
+    col.update_note(n1)
+    # Notes changed in the same second as the last refresh are returned again
+    assert n1.id in index.changed_notes(col)
+    assert index.get(col).dependents([n1.id]) == [n2.id]
+    assert index.get(col).dependents([n1.id, n2.id]) == [n2.id, n3.id]
+
+
+def test_changed_since_opened(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    index.opened(col)
+    n1['Front'] = 'Changed'
+    col.update_note(n1)
+    # The first edit after opening is returned although the index is built by it
+    assert n1.id in index.changed_notes(col)
+    assert index.get(col).dependents([n1.id]) == [n2.id]
+
+
+def test_changed_by_sync(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    n3 = add_basic(col, 'Source')
+    assert index.changed_notes(col) == []  # index built
+
+    # Pulled by an AnkiWeb sync, the note keeps its older remote modification time
+    col.db.execute('update notes set flds = ?, mod = 1, usn = 5 where id = ?',
+                   f'<span class="sync" note="{n3.id}"></span>\x1f', n2.id)
+    assert n2.id in index.changed_notes(col)
+    assert index.get(col).dependents([n3.id]) == [n2.id]
+
+
+def test_refresh_bounded(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    # Sent by an earlier AnkiWeb sync and not changed since
+    col.db.execute('update notes set usn = 3')
+    assert index.changed_notes(col) == []  # index built
+
+    n1['Front'] = 'Changed'
+    col.update_note(n1)
+    assert index.changed_notes(col) == [n1.id]
+    assert index.get(col).dependents([n1.id]) == [n2.id]
+
+
+def test_refresh_notes(col):
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    assert index.current(col) is None
+    sync_index = index.get(col)
+    assert index.current(col) is sync_index
+
+    n2['Front'] = 'No reference'
+    col.update_note(n2)
+    n3 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    sync_index.refresh_notes(col, [n2.id])
+    assert sync_index.report(n1.id).referencing == []
+    # Other notes are left for the next refresh
+    assert n3.id in index.changed_notes(col)
+    assert sync_index.report(n1.id).referencing == [n3.id]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_rebuild(col, workers, monkeypatch):
+    monkeypatch.setattr(index, 'CHUNK_SIZE', 2)
+    monkeypatch.setattr(index, 'PARALLEL_MIN_NOTES', 0)
+    n1 = add_basic(col, 'Source')
+    n2 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>')
+    n3 = add_basic(col, '<span class="sync" sid="1">A</span>')
+    n4 = add_basic(col, f'<span class="sync" note="{n1.id}"></span>', '<span class="sync" sid="2">B</span>')
+    current = index.get(col)
+
+    # Changes behind the index's back, e.g. manual SQL
+    col.db.execute('update notes set flds = ? where id = ?', 'Plain\x1f', n2.id)
+    col.db.execute('update notes set flds = ? where id = ?', '<span class="sync" sid="3">C</span>\x1f', n3.id)
+    current.entries.pop(n4.id)
+
+    rebuilt = index.rebuild(col, workers)
+    assert sorted(rebuilt.entries) == [n3.id, n4.id]
+    assert index.install(col, rebuilt) == index.Verification([n4.id], [n2.id], [n3.id])
+    assert index.get(col) is rebuilt
+    assert index.install(col, index.rebuild(col)) == index.Verification([], [], [])
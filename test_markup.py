@@ -0,0 +1,188 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from bs4 import BeautifulSoup
+
+from . import bidir, markup, unidir
+from .test_utils import get_empty_col, load_notes
+
+FIELDS = [
+    '',
+    ' ',
+    '\n',
+    'text',
+    '  leading whitespace',
+    '\n<div>a</div>\n',
+    '<span class="sync" note="1">\n<div>one&nbsp;two</div>\n</span>',
+    'Before <span class="sync" sid="1_0_0001">Content</span> After',
+    '<div class="first-upper">cringeis&nbsp;cringe.</div>',
+    '<ol><li>Context1</li><li>Before [[assumption2::Hint Assumptions]]</li></ol>',
+    '<div>\\[a < b\\]</div>',
+    '<img src="data:image/png;base64,AAAA"><br>',
+    '<p>a<p>b',
+    '<li>a<li>b',
+    '<b><p>x</p></b>',
+    '<a>1<a>2</a></a>',
+    '<table><tr><td>1</td></tr></table>',
+    '<span>x<div>y</span>z',
+    'a&b &unknown; &amp;',
+    'x<![CDATA[y]]>',
+    '<hr class="a"/> ',
+    'line\r\nbreak',
+    '<html>x</html>',
+]
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+@pytest.fixture
+def lxml_backend():
+    if not markup.HAS_LXML:
+        pytest.skip('lxml is not installed')
+    markup.set_backend('lxml')
+    yield
+    markup.set_backend('html.parser')
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        markup.set_backend('foo')
+    assert markup.get_backend() == 'html.parser'
+
+
+@pytest.mark.parametrize('text', FIELDS)
+def test_default_backend(text):
+    expected = BeautifulSoup(text, 'html.parser').encode(formatter='html5').decode('utf-8')
+    assert markup.serialize(markup.parse(text)) == expected
+
+
+@pytest.mark.parametrize('text', FIELDS)
+def test_lxml_identical_output(lxml_backend, text):
+    expected = BeautifulSoup(text, 'html.parser').encode(formatter='html5').decode('utf-8')
+    assert markup.serialize(markup.parse(text)) == expected
+
+
+def test_lxml_top_level_spans(lxml_backend):
+    bs = markup.parse('\n<div>a</div><span class="sync" note="1"></span>')
+    spans = bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False)
+    assert len(spans) == 1
+
+
+def test_lxml_unidir(lxml_backend, col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front1 <b>Front bold</b> Front2'
+    n1['Back'] = 'Back1&nbsp;<i>Back</i>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f' <span class="sync" note="{n1.id}"></span> '
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n1, n2))
+
+    assert n2['Front'] == (
+        f' <span class="sync" note="{n1.id}">\n'
+        '<div>\n'
+        '  Front1 <b>Front bold</b> Front2\n'
+        '  <hr>\n'
+        '  Back1&nbsp;<i>Back</i>\n'
+        '</div>\n'
+        '</span> ')
+    assert unidir.sync_field(col, n2, 0) is False
+
+
+def test_lxml_bidir(lxml_backend, col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1"><b>Original content</b></span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<div>Before</div><span class="sync" sid="1"></span>'
+    col.add_note(n2, 0)
+
+    assert bidir.sync_field(col, n2, 0, lambda _: 'Download') is True
+    load_notes((n1, n2))
+
+    assert n2['Front'] == '<div>Before</div><span class="sync" sid="1"><b>Original content</b></span>'
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('<DIV CLASS=x>a</DIV> <span id=1>old</span><br/>', '<DIV CLASS=x>a</DIV> <span id="1">new</span><br/>'),
+    ('<span id="1"><span>old</span></span>&#32;', '<span id="1">new</span>&#32;'),
+    ('<span id="1">old', '<span id="1">new</span>'),
+    ('<b><span id="1">old</span></b><span id="1">old</span>', '<b><span id="1">old</span></b><span id="1">new</span>'),
+])
+def test_replace_elements(text, expected):
+    bs = markup.parse(text)
+    old = bs.find('span', recursive=False)
+    new = bs.new_tag('span', id='1')
+    new.string = 'new'
+    assert markup.replace_elements(text, bs, [(old, new)]) == expected
+
+
+def test_replace_elements_fallback():
+    bs = markup.parse('<br/><span id="1">old</span>')
+    old = bs.find('span', recursive=False)
+    new = bs.new_tag('span', id='1')
+    assert markup.replace_elements('<br/>', bs, [(old, new)]) == '<br><span id="1"></span>'
+    assert markup.replace_elements('<br/>', bs, [(old, '')]) == '<br>'
+
+
+@pytest.mark.parametrize('text', FIELDS)
+def test_replace_nothing(text):
+    assert markup.replace_elements(text, markup.parse(text), []) == text
+
+
+def test_replace_elements_html():
+    text = '<b>a</b><span class="sync" id="1">old</span>'
+    bs = markup.parse(text)
+    old = bs.find('span', recursive=False)
+    new = markup.element_html('span', dict(old.attrs), '<div>new&nbsp;</div>')
+    assert new == '<span class="sync" id="1"><div>new&nbsp;</div></span>'
+    assert markup.replace_elements(text, bs, [(old, new)]) == '<b>a</b>' + new
+
+
+@pytest.mark.parametrize('text', FIELDS + [
+    '<br><br/><span class="sync" note="1"></span>',
+    '<a b=c/><span class="sync" note="1"><br/></span>',
+    '<span class="sync" note="1"/><SPAN class="x sync" note=2>a<span>b</span>c</SPAN>',
+])
+def test_locate_sync_spans(monkeypatch, text):
+    monkeypatch.setattr(markup, 'LARGE_FIELD', 0)
+    located = markup.locate_sync_spans(text)
+    if located is None:
+        return  # not in the supported subset, parsed as a whole
+    spans = markup.parse(text).find_all('span', {'class': 'sync'}, recursive=False)
+    assert [str(span) for span in spans] == [str(span.element) for span in located]
+
+
+def test_locate_large_field():
+    image = '<img src="data:image/png;base64,' + 'A' * markup.LARGE_FIELD + '">'
+    text = image + '<div><span class="sync" note="1"></span></div><span class="sync" sid="1">x</span>'
+    located = markup.locate_sync_spans(text)
+    assert [str(span.element) for span in located] == ['<span class="sync" sid="1">x</span>']
+    assert markup.splice(text, [(located[0], '<b>y</b>')]) == text[:located[0].start] + '<b>y</b>'
+
+    assert markup.locate_sync_spans(text[-100:]) is None  # small field
+    assert markup.locate_sync_spans('<!-- c -->' + text) is None  # comments are not scanned
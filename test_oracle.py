@@ -0,0 +1,137 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import bidir, markup, oracle, unidir
+from .test_utils import get_empty_col
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+def add_notes(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front <b>text</b>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<DIV>Before</DIV><span class="sync" note="{n1.id}"></span>'
+    n2['Back'] = f'<span class="sync" fields="Front" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    return n1, n2
+
+
+def test_no_mismatch(col):
+    n1, n2 = add_notes(col)
+    backend = markup.get_backend()
+
+    report = oracle.compare_notes(col, [n1.id, n2.id])
+    assert report.fields == 4
+    assert report.mismatches == []
+    assert report.speedup > 0
+    # The notes and the fast path state are left untouched
+    assert col.get_note(n2.id).fields == n2.fields
+    assert markup.get_backend() == backend
+    assert len(unidir.Fetcher.render_cache) > 0
+
+
+def test_stamps_and_clozes(col, monkeypatch):
+    monkeypatch.setattr(unidir, 'use_stamps', True)
+    n1 = col.new_note(col.models.by_name('Cloze'))
+    n1['Text'] = '{{c1::outer {{c2::inner::hint}} text}} [[oc1::kept]]'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(col.models.by_name('Basic'))
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert oracle.compare_notes(col, [n2.id]).mismatches == []
+    unidir.sync_note(col, n2)
+    assert 'stamp=' in n2['Front']
+    # Up to date and stamped, left as it is by both
+    assert oracle.compare_notes(col, [n2.id]).mismatches == []
+    assert unidir.use_stamps is True
+
+
+def test_mismatch(col):
+    n1, n2 = add_notes(col)
+    unidir.Fetcher.render_cache.clear()
+    oracle.compare_notes(col, [n2.id])
+
+    # A stale cache entry makes the fast path diverge
+    for key in unidir.Fetcher.render_cache:
+        unidir.Fetcher.render_cache[key] = ('<div>stale</div>', frozenset())
+    report = oracle.compare_notes(col, [n2.id])
+    assert [(m.nid, m.field_idx) for m in report.mismatches] == [(n2.id, 0), (n2.id, 1)]
+    assert 'stale' in report.mismatches[0].fast
+    assert 'Front' in report.mismatches[0].reference
+    unidir.Fetcher.render_cache.clear()
+
+
+def test_splice_checked(col, monkeypatch):
+    n1, n2 = add_notes(col)
+    unidir.Fetcher.render_cache.clear()
+
+    # A splice touching bytes outside the spans, the tree stays the same
+    replace = markup.SyncSpans.replace
+    monkeypatch.setattr(markup.SyncSpans, 'replace', lambda self, replacements: replace(
+        self, replacements).replace('<DIV>Before</DIV>', '<div>Before</div>'))
+    report = oracle.compare_notes(col, [n2.id])
+    assert [(m.nid, m.field_idx, m.kind) for m in report.mismatches] == [(n2.id, 0, 'unidir')]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a<span class="sync" note="1">b<span>c</span>d</span>e', ['a', 'e']),
+    ('<span class="sync" sid="1"/>x<b><span class="sync">y</span></b>', ['', 'x<b><span class="sync">y</span></b>']),
+    ('x\n<span class="sync" note="1"><b>open', ['x\n', '']),
+])
+def test_outside_spans(text, expected):
+    assert oracle.outside_spans(text) == expected
+
+
+def add_bidir_notes(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = ('<b>Mine</b> <span class="sync" rev="1" sid="1">Mine</span>'
+                   '<span class="sync" rev="1" sid="2">Two</span>')
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" rev="1" sid="1">Theirs</span>'
+    n2['Back'] = '<span class="sync" sid="2">Old</span>'
+    col.add_note(n2, 0)
+    return n1, n2
+
+
+def test_bidir(col, monkeypatch):
+    n1, n2 = add_bidir_notes(col)
+    stored = [col.get_note(nid).fields for nid in (n1.id, n2.id)]
+
+    report = oracle.compare_notes(col, [n1.id])
+    assert report.mismatches == []
+    # Uploads are only recorded
+    assert [col.get_note(nid).fields for nid in (n1.id, n2.id)] == stored
+
+    # An upload with a wrong revision is caught in the other note
+    revise = bidir.revise
+    monkeypatch.setattr(bidir, 'revise', lambda span, rev, origin: revise(span, rev + 1, origin))
+    report = oracle.compare_notes(col, [n1.id])
+    assert {(m.nid, m.kind) for m in report.mismatches} == {(n1.id, 'bidir'), (n2.id, 'bidir')}
@@ -0,0 +1,59 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .render_store import RenderStore
+
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / 'user_files' / 'render_cache.sqlite')
+    store = RenderStore(path)
+    assert store.get('a') is None
+    store.put('a', '<div>a</div>', frozenset({'1', '2'}))
+    assert store.get('a') == ('<div>a</div>', frozenset({'1', '2'}))
+    store.close()
+
+    store = RenderStore(path)
+    assert store.get('a') == ('<div>a</div>', frozenset({'1', '2'}))
+    store.close()
+
+
+def test_eviction(tmp_path):
+    store = RenderStore(str(tmp_path / 'render_cache.sqlite'), max_entries=2)
+    store.put('a', 'a', frozenset())
+    store.put('b', 'b', frozenset())
+    store.flush()
+    store.db.execute('update blocks set used = used - 10 where key = ?', ('a',))  # used long ago
+    store.put('c', 'c', frozenset())
+    store.flush()
+    assert store.get('a') is None
+    assert store.get('b') is not None
+    assert store.get('c') is not None
+    store.close()
+
+
+def test_version(tmp_path):
+    path = str(tmp_path / 'render_cache.sqlite')
+    store = RenderStore(path, version=1)
+    store.put('a', 'a', frozenset())
+    store.close()
+
+    store = RenderStore(path, version=1)
+    assert store.get('a') is not None
+    store.close()
+
+    # Written by another version of the renderer
+    store = RenderStore(path, version=2)
+    assert store.get('a') is None
+    store.close()
@@ -0,0 +1,120 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import index, scheduler
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    col = get_empty_col()
+    yield col
+    index.drop(col)
+
+
+def test_run(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = f'<span class="sync" note="{n2.id}"></span>'
+    col.add_note(n3, 0)
+
+    n4 = col.new_note(basic)
+    n4['Front'] = '<span class="sync" rev="2" sid="1">New</span>'
+    col.add_note(n4, 0)
+
+    n5 = col.new_note(basic)
+    n5['Front'] = '<span class="sync" rev="1" sid="1">Old</span>'
+    n5['Back'] = '<span class="sync" sid="2">Mine</span>'
+    col.add_note(n5, 0)
+
+    n6 = col.new_note(basic)
+    n6['Front'] = '<span class="sync" sid="2">Theirs</span>'
+    col.add_note(n6, 0)
+
+    work = scheduler.Scheduler()
+    work.fill(col)
+    assert work
+    assert work.run(col, 0) == []  # nothing fits in no time
+
+    while work:
+        work.run(col, 1)
+    load_notes((n2, n3, n4, n5, n6))
+
+    assert 'Front' in n2['Front']
+    assert 'Front' in n3['Front']  # rendered again after n2 changed
+    assert n5['Front'] == n4['Front'] == '<span class="sync" rev="2" sid="1">New</span>'
+    # Copies of the same revision are left for the user
+    assert n5['Back'] == '<span class="sync" sid="2">Mine</span>'
+    assert n6['Front'] == '<span class="sync" sid="2">Theirs</span>'
+
+
+def test_deleted_note(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front'
+    col.add_note(n1, 0)
+
+    work = scheduler.Scheduler()
+    work.add_notes([n1.id, n1.id])
+    assert len(work.notes) == 1
+    col.remove_notes([n1.id])
+    assert work.run(col, 1) == []
+    assert not work
+
+
+def test_single_undo_step(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front'
+    col.add_note(n1, 0)
+
+    nids = []
+    for _ in range(3):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, 0)
+        nids.append(note.id)
+
+    work = scheduler.Scheduler()
+    work.add_notes(nids[:2])
+    work.run(col, 1)
+    step = col.undo_status().last_step
+    work.add_notes(nids[1:])
+    work.run(col, 1)
+    # Consecutive slices share a step
+    assert col.undo_status().last_step == step
+    assert col.undo_status().undo == scheduler.LABEL
+
+    # A slice after another change starts a new one
+    n1['Front'] = 'Changed'
+    col.update_note(n1)
+    work.add_notes(nids[:1])
+    work.run(col, 1)
+    assert col.undo_status().undo == scheduler.LABEL
+    col.undo()
+    assert col.undo_status().undo != scheduler.LABEL
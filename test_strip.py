@@ -0,0 +1,100 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from .strip import Strip, strip, strip_batch
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{{c1::one}}', 'one'),
+    ('{{c1::one}} {{c2::two}}', 'one two'),
+    ('{{c1::one::hint}}', 'one'),
+    ('{{c1::one::h1}} {{c12::two::h2}}', 'one two'),
+    ('{{c1::one\ntwo}}', 'one\ntwo'),
+    ('{{c1::a {{c2::b}}}}', 'a b'),
+    ('{{c1::a {{c2::b::h2}} c::h1}}', 'a b c'),
+    ('{{c1::a::h {{c2::b}}}}', 'a'),
+    ('{{c1::}}', ''),
+    ('{{c1::a}', '{{c1::a}'),
+    ('{{c1::a {{c2::b}}', '{{c1::a b'),
+    ('a}} b::c [[oc1::d]]', 'a}} b::c [[oc1::d]]'),
+])
+def test_cloze(text, expected):
+    assert strip(text, Strip.CLOZE) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('[[oc1::one]]', 'one'),
+    ('[[oc1::one::hint]] [[oc2::two]]', 'one two'),
+    ('[[oc1::a [[oc2::b]]]]', 'a b'),
+    ('[[a::b]] {{c1::c}}', '[[a::b]] {{c1::c}}'),
+])
+def test_cloze_overlapping(text, expected):
+    assert strip(text, Strip.CLOZE_OVERLAPPING) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('[[a::b]]', 'a'),
+    ('[[a]]', 'a'),
+    ('x [[oc1::a::h]] y', 'x oc1 y'),
+    ('<li>Before [[assumption2::Hint Assumptions]]</li>', '<li>Before assumption2</li>'),
+])
+def test_assumption_hints(text, expected):
+    assert strip(text, Strip.ASSUMPTION_HINTS) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a::b::c', 'a'),
+    ('abc', 'abc'),
+    ('::x', ''),
+    ('EQ1::Hint EQ1', 'EQ1'),
+    ('x {{c1::y}}', 'x {{c1'),
+])
+def test_im_eq_hints(text, expected):
+    assert strip(text, Strip.IM_EQ_HINTS) == expected
+
+
+def test_none():
+    assert strip('{{c1::a::b}} [[c::d]]', Strip.NONE) == '{{c1::a::b}} [[c::d]]'
+
+
+def test_combined():
+    flags = Strip.CLOZE | Strip.CLOZE_OVERLAPPING | Strip.ASSUMPTION_HINTS
+    assert strip('{{c1::a::h}} [[oc1::b::h]] [[c::h]]', flags) == 'a b c'
+
+
+def test_batch():
+    texts = ['{{c1::a', 'b}}', '{{c1::c::h}}', '', 'd']
+    assert strip_batch(texts, Strip.CLOZE) == ['{{c1::a', 'b}}', 'c', '', 'd']
+    assert strip_batch(['a::b', 'c', 'd::e'], Strip.IM_EQ_HINTS) == ['a', 'c', 'd']
+    assert strip_batch([], Strip.CLOZE) == []
+
+
+def test_deep_nesting():
+    depth = 20000
+    text = '{{c1::a' * depth + '::hint}}' + '}}' * (depth - 1)
+    assert strip(text, Strip.CLOZE) == 'a' * depth
+
+
+def test_many_unclosed():
+    text = '{{c1::a::b' * 20000
+    assert strip(text, Strip.CLOZE) == text
+
+
+def test_many_hints():
+    text = '{{c1::a' + '::b' * 20000 + '}}'
+    assert strip(text, Strip.CLOZE) == 'a'
+    assert strip(text, Strip.IM_EQ_HINTS) == '{{c1'
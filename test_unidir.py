@@ -14,12 +14,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import sqlite3
 from typing import Sequence
 
+import anki.errors
 import pytest
 from anki.notes import Note
 
-from . import unidir
+from . import markup, unidir
 from .test_utils import get_empty_col, load_notes
 
 
@@ -494,3 +496,430 @@ def test_field_excluded_from_unqualified_search(col):
         '</div>\n'
         '</span>'
     )
+
+
+def test_sync_all_scope(col):
+    basic = col.models.by_name('Basic')
+    basic_reversed = col.models.by_name('Basic (and reversed card)')
+    active = col.decks.id('Active')
+    archive = col.decks.id('Archive')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Old'
+    col.add_note(n1, archive)
+
+    notes = []
+    for notetype, deck in ((basic, active), (basic_reversed, active), (basic, archive)):
+        note = col.new_note(notetype)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, deck)
+        notes.append(note)
+
+    assert unidir.sync_all(col, decks=['Active'], notetypes=['Basic']) == 1
+    load_notes(notes)
+    assert ['Old' in note['Front'] for note in notes] == [True, False, False]
+
+    # Blocks rendered over several lines are found again
+    n1['Front'] = 'New'
+    col.update_note(n1)
+    assert unidir.sync_all(col, search=f'-nid:{notes[2].id}') == 2
+    load_notes(notes)
+    assert ['New' in note['Front'] for note in notes] == [True, True, False]
+
+    with pytest.raises(anki.errors.SearchError):
+        unidir.sync_all(col, search='deck:(')
+
+
+def test_sync_all_fields_attribute(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Old'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}" fields="Front"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    # Rendered with sorted attributes, the note follows the selected fields
+    assert n2['Front'] == f'<span class="sync" fields="Front" note="{n1.id}">\n<div>Old</div>\n</span>'
+
+    n1['Front'] = 'New'
+    col.update_note(n1)
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" fields="Front" note="{n1.id}">\n<div>New</div>\n</span>'
+
+
+def test_fields_attribute(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    n1['Back'] = 'Back text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" fields="Back Front" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n1, n2))
+
+    assert n2['Front'] == (
+        f'<span class="sync" fields="Back Front" note="{n1.id}">\n'
+        '<div>Back text</div>\n'
+        '<div>Front text</div>\n'
+        '</span>'
+    )
+
+
+def test_fields_attribute_stripped(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one::hint}} {{c2::two}}'
+    n1['Back Extra'] = '{{c1::extra}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" fields="Text Back Extra" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n1, n2))
+
+    # Only fields stripped by the note type template are stripped
+    assert n2['Front'] == (
+        f'<span class="sync" fields="Text Back Extra" note="{n1.id}">\n'
+        '<div>one two</div>\n'
+        '<div>{{c1::extra}}</div>\n'
+        '</span>'
+    )
+
+
+def test_fields_attribute_unknown_field(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" fields="Foo" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n1, n2))
+
+    assert n2['Front'] == f'<span class="sync" fields="Foo" note="{n1.id}"><div>Unknown field</div></span>'
+
+
+def test_fields_attribute_cycles(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    col.add_note(n1, 0)
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" fields="Back" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    n1['Front'] = f'<span class="sync" note="{n2.id}"></span>'
+    n1['Back'] = 'Back text'
+    col.update_note(n1)
+
+    # The cyclic field is not selected
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n1, n2))
+
+    assert n2['Front'] == f'<span class="sync" fields="Back" note="{n1.id}">\n<div>Back text</div>\n</span>'
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Front', ('Front',)),
+    ('Back  Front', ('Back', 'Front')),
+    ('Context Left Cloze', ('Context Left', 'Cloze')),
+    ('Context Left Context', ('Context Left', 'Context')),
+    ('', ()),
+])
+def test_parse_fields(value, expected):
+    names = ('Front', 'Back', 'Context Left', 'Cloze', 'Context')
+    assert unidir.Fetcher.parse_fields(value, names) == expected
+
+
+def test_render_cache(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    n2['Back'] = f'<span class="sync" fields="Front" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    unidir.Fetcher.render_cache.clear()
+    assert unidir.sync_note(col, n2) is True
+    assert len(unidir.Fetcher.render_cache) == 2
+
+    # Rendering for another note reuses the cached blocks
+    n3 = col.new_note(basic)
+    n3['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n3, 0)
+    assert unidir.sync_field(col, n3, 0) is True
+    assert len(unidir.Fetcher.render_cache) == 2
+
+    # A changed source note is rendered again
+    n1['Front'] = 'New text'
+    col.update_note(n1)
+    assert unidir.sync_field(col, n3, 0) is True
+    assert len(unidir.Fetcher.render_cache) == 3
+    load_notes((n3,))
+    assert 'New text' in n3['Front']
+
+
+def test_render_cache_notetype_changed(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    assert unidir.sync_field(col, n2, 0) is True
+
+    # Blocks cached for the note type before the change are not used
+    monkeypatch.setitem(unidir.Fetcher.template_cache, 'Basic', unidir.Fetcher.tokenize('<b>{{Front}}</b>'))
+    unidir.invalidate_notetypes(col)
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<b>Front text</b></span>'
+    monkeypatch.undo()
+    unidir.invalidate_notetypes(col)
+
+
+def test_persistent_render_cache(col, tmp_path):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    path = str(tmp_path / 'render_cache.sqlite')
+    unidir.Fetcher.render_cache.clear()
+    unidir.open_store(path, 10)
+    try:
+        assert unidir.sync_all(col) == 1
+        unidir.close_store()
+
+        # A new session renders from the stored block, marked here to tell it apart
+        with sqlite3.connect(path) as db:
+            db.execute("update blocks set html = replace(html, 'Front text', 'Stored text')")
+        db.close()
+        unidir.Fetcher.render_cache.clear()
+        unidir.open_store(path, 10)
+        n3 = col.new_note(basic)
+        n3['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(n3, 0)
+        assert unidir.sync_field(col, n3, 0) is True
+        load_notes((n3,))
+        assert 'Stored text' in n3['Front']
+    finally:
+        unidir.close_store()
+        unidir.Fetcher.render_cache.clear()
+
+
+def test_notetype_cache(col):
+    basic = col.models.by_name('Basic')
+    note = col.new_note(basic)
+
+    info = unidir.notetype_info(note)
+    assert info.name == 'Basic'
+    assert info.fields == {'Front': 0, 'Back': 1}
+    assert info.tokens is not None
+    assert unidir.notetype_info(note) is info
+
+    # Cached metadata is stale until the note type change is announced
+    col.models.add_field(basic, col.models.new_field('Extra'))
+    col.models.update_dict(basic)
+    assert unidir.notetype_info(note) is info
+    unidir.invalidate_notetypes(col)
+    assert unidir.notetype_info(note).fields == {'Front': 0, 'Back': 1, 'Extra': 2}
+
+
+def test_unrelated_markup_kept(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<DIV CLASS=x>a<br/></DIV>\n<span class="sync" note="{n1.id}"></span>&#32;'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    assert n2['Front'].startswith('<DIV CLASS=x>a<br/></DIV>\n<span class="sync" note=')
+    assert n2['Front'].endswith('</span>&#32;')
+
+    mod = n2.mod
+    assert unidir.sync_note(col, n2) is False
+    load_notes((n2,))
+    assert n2.mod == mod
+
+
+def test_large_field(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    table = '<table>' + '<tr><td>cell<br></td></tr>' * 1000 + '</table>'
+    n2 = col.new_note(basic)
+    n2['Front'] = f'{table}<span class="sync" note="{n1.id}"></span><TABLE><tr><td>x</TABLE>'
+    col.add_note(n2, 0)
+    assert len(n2['Front']) > markup.LARGE_FIELD
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    assert n2['Front'].startswith(f'{table}<span class="sync" note="{n1.id}">\n<div>\n  Front text')
+    assert n2['Front'].endswith('</span><TABLE><tr><td>x</TABLE>')
+    assert unidir.sync_field(col, n2, 0) is False
+
+
+def test_preload_notetypes(col):
+    unidir.invalidate_notetypes(col)
+    unidir.preload_notetypes(col)
+    cached = unidir._notetypes[col.path]
+    assert len(cached) == len(col.models.all_names_and_ids())
+    basic = col.models.by_name('Basic')
+    assert cached[basic['id']].tokens is not None
+
+
+@pytest.fixture
+def stamps():
+    unidir.use_stamps = True
+    yield
+    unidir.use_stamps = False
+
+
+def test_stamps(col, stamps, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    fetcher = unidir.Fetcher(n2, n1)
+    stamp = fetcher.block_stamp(fetcher.fetch_html())
+    assert f'note="{n1.id}" stamp="{stamp}">' in n2['Front']
+
+    # Fresh blocks are not rendered at all
+    monkeypatch.setattr(unidir.Fetcher, 'fetch_html', None)
+    assert unidir.sync_field(col, n2, 0) is False
+    monkeypatch.undo()
+
+    # The stamp covers the note the block is rendered into
+    n3 = col.new_note(basic)
+    col.add_note(n3, 0)
+    assert unidir.Fetcher(n3, n1).block_stamp(fetcher.fetch_html()) != stamp
+
+    n1['Front'] = 'New text'
+    col.update_note(n1)
+    fetcher = unidir.Fetcher(n2, n1)
+    assert fetcher.block_stamp(fetcher.fetch_html()) != stamp
+    assert unidir.Fetcher(n2, n1, 'Front').stamp() != fetcher.stamp()
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    assert 'New text' in n2['Front']
+    assert f'stamp="{fetcher.block_stamp(fetcher.fetch_html())}"' in n2['Front']
+
+
+def test_stamps_hand_edit(col, stamps):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    rendered = n2['Front']
+
+    # Edited inside the block, the stamp no longer matches
+    n2['Front'] = rendered.replace('Front text', 'Typed')
+    col.update_note(n2)
+    assert unidir.sync_field(col, n2, 0) is True
+    load_notes((n2,))
+    assert n2['Front'] == rendered
+
+
+def test_stamps_not_written_alone(col, stamps):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'Front text'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    unidir.use_stamps = False
+    assert unidir.sync_field(col, n2, 0) is True
+    unidir.use_stamps = True
+
+    # Up to date blocks without a stamp are not rewritten just to add one
+    assert unidir.sync_field(col, n2, 0) is False
+    load_notes((n2,))
+    assert 'stamp' not in n2['Front']
+
+
+def test_stamps_refreshed(col, stamps, monkeypatch):
+    n1 = col.new_note(col.models.by_name('Cloze'))
+    n1['Text'] = '{{c1::x}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(col.models.by_name('Basic'))
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    rendered = n2['Front']
+
+    # Fields the template does not read are not part of the stamp
+    n1['Back Extra'] = 'Extra'
+    col.update_note(n1)
+    monkeypatch.setattr(unidir.Fetcher, 'fetch_html', None)
+    assert unidir.sync_all(col) == 0
+    monkeypatch.undo()
+
+    # The rendered block stays the same, only its stamp is rewritten
+    n1['Text'] = '{{c2::x}}'
+    col.update_note(n1)
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] != rendered
+    assert n2['Front'].split('>', 1)[1] == rendered.split('>', 1)[1]
+
+    monkeypatch.setattr(unidir.Fetcher, 'fetch_html', None)
+    assert unidir.sync_all(col) == 0
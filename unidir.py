@@ -13,24 +13,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 import os
 import re
-import warnings
-from copy import copy
-from typing import NamedTuple
+from typing import Mapping, NamedTuple, Sequence
 
 import anki.errors
-from anki.collection import Collection
-from anki.notes import Note
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from anki.collection import Collection, SearchNode
+from anki.models import NotetypeId
+from anki.notes import Note, NoteId
+from bs4 import BeautifulSoup, Tag
 
-warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+from . import cas, markup
+from .render_store import RenderStore
+from .strip import SEPARATOR, Strip, strip_batch
 
 
-def _show_synced_notes():
-    # TODO: additional hook editor_did_load_note?
-    # text field with clickable ids in menu bar
-    pass
+# Mark rendered blocks with a digest of their inputs and skip rendering fresh ones
+use_stamps = False
+# Rendered blocks persisted across sessions, behind the in-memory render cache
+store: RenderStore | None = None
+# Increase whenever rendering, stripping or serializing blocks changes, blocks persisted before are dropped
+RENDER_VERSION = 1
 
 
 class Fetcher():
@@ -42,71 +46,77 @@ class Fetcher():
     ]
     RE_TOKENS = re.compile('|'.join(f'(?P<{kind}>{value})' for kind, value in TOKENS), re.DOTALL)
     RE_FIELD = re.compile(r'{{(?P<field>[^:]+?)(?P<type>:\w*)?}}')
-    RE_CLOZE = re.compile(r'{{c\d+::(.*?)(::.*?)?}}', re.DOTALL)
-    RE_CLOZE_OVERLAPPER = re.compile(r'\[\[oc\d+::(.*?)(::.*?)?\]\]', re.DOTALL)
-    RE_ASSUMPTION_HINT = re.compile(r'\[\[(.*?)(::.+?)?\]\]')
-    RE_EQ_IM_HINT = re.compile(r'(.*?)(::.*)?', re.DOTALL)
+    STRIP = {
+        'FIELD_NORMAL': Strip.NONE,
+        'FIELD_CLOZE': Strip.CLOZE,
+        'FIELD_CLOZE_OVERLAPPING': Strip.CLOZE_OVERLAPPING,
+        'FIELD_ASSUMPTIONS': Strip.ASSUMPTION_HINTS,
+        'FIELD_IM_EQ_HINT': Strip.IM_EQ_HINTS,
+    }
 
     template_cache = {}
+    # Rendered (html, referenced note ids), keyed by (note type digest, selected fields, field values)
+    render_cache: dict[tuple, tuple[str, frozenset[str]]] = {}
+    RENDER_CACHE_SIZE = 4096
 
-    def __init__(self, this_note: Note, other_note: Note):
+    def __init__(self, this_note: Note, other_note: Note, fields: str | None = None):
         self.this_note = this_note
         self.other_note = other_note
-        self.other_notetype = self.other_note.note_type()['name']
-        try:
-            if self.other_notetype not in self.template_cache:
-                with open(os.path.join(os.path.dirname(__file__),
-                                       f'./user_files/templates/{self.other_notetype}.html'), 'r') as f:
-                    self.template_cache[self.other_notetype] = self.tokenize(f.read())
-        except IOError:
+        self.notetype = notetype_info(other_note)
+        if self.notetype.tokens is None:
             raise ValueError('Unknown model')
+        self.fields = None if fields is None else self.parse_fields(fields, self.notetype.fields)
 
     @classmethod
-    def __strip_cloze(cls, text: str):
-        # TODO: nested clozes (add rust function)
-        return Fetcher.RE_CLOZE.sub(r'\1', text)
-
-    @classmethod
-    def __strip_cloze_overlapping(cls, text: str):
-        # TODO: nested clozes
-        return Fetcher.RE_CLOZE_OVERLAPPER.sub(r'\1', text)
-
-    @classmethod
-    def __strip_assumption_hints(cls, text: str):
-        return Fetcher.RE_ASSUMPTION_HINT.sub(r'\1', text)
-
-    @classmethod
-    def __strip_im_eq_hints(cls, text: str):
-        return Fetcher.RE_EQ_IM_HINT.sub(r'\1', text)
-
-    def __check_cycles(self, text_other: str):
-        bs = BeautifulSoup(text_other, 'html.parser')
-        spans = bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False)
-        for span in spans:
-            other_id = span.get('note')
-            if other_id == str(self.this_note.id):
-                raise ValueError('Cycle detected')
-        return text_other
-
-    def __fetch_field(self, field: str):
-        text = self.other_note[field]
-        return self.__check_cycles(text)
-
-    def __fetch_cloze_field(self, field: str):
-        text = self.__strip_cloze(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_cloze_overlapping_field(self, field: str):
-        text = self.__strip_cloze_overlapping(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_assumptions_field(self, field: str):
-        text = self.__strip_assumption_hints(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_im_eq_hint_field(self, field: str):
-        text = self.__strip_im_eq_hints(self.other_note[field])
-        return self.__check_cycles(text)
+    def load_template(cls, notetype: str) -> list['Fetcher.Token'] | None:
+        if notetype not in cls.template_cache:
+            try:
+                with open(os.path.join(os.path.dirname(__file__),
+                                       f'./user_files/templates/{notetype}.html'), 'r') as f:
+                    cls.template_cache[notetype] = cls.tokenize(f.read())
+            except IOError:
+                return None
+        return cls.template_cache[notetype]
+
+    @staticmethod
+    def parse_fields(value: str, names: Sequence[str]) -> tuple[str, ...]:
+        '''
+        Split a space separated list of field names. Names containing spaces
+        are matched greedily, e.g. 'Context Left Cloze' -> ('Context Left', 'Cloze').
+        '''
+        names = set(names)
+        words = value.split()
+        fields = []
+        i = 0
+        while i < len(words):
+            for j in range(len(words), i, -1):
+                name = ' '.join(words[i:j])
+                if name in names:
+                    fields.append(name)
+                    i = j
+                    break
+            else:
+                raise ValueError('Unknown field')
+        return tuple(fields)
+
+    @staticmethod
+    def __references(text: str) -> frozenset[str]:
+        if 'sync' not in text:
+            return frozenset()
+        return frozenset(span['note'] for span in markup.SyncSpans(text).spans if span.has_attr('note'))
+
+    def __strip(self, fields: Sequence[tuple[str, Strip]]) -> list[str]:
+        # Strip all fields needing the same transform in one pass
+        batches: dict[Strip, list[int]] = {}
+        for i, (_, flags) in enumerate(fields):
+            batches.setdefault(flags, []).append(i)
+        out = [''] * len(fields)
+        for flags, batch in batches.items():
+            values = self.other_note.fields
+            texts = strip_batch((values[self.notetype.fields[fields[i][0]]] for i in batch), flags)
+            for i, text in zip(batch, texts):
+                out[i] = text
+        return out
 
     class Token(NamedTuple):
         type: str
@@ -150,35 +160,173 @@ class Fetcher():
 
         return tokens
 
-    def fetch(self):
-        out = '\n'
+    def __render_template(self) -> tuple[str, frozenset[str]]:
+        refs = frozenset()
+        tokens = []
         skip = ''
-        for token in self.template_cache[self.other_notetype]:
+        for token in self.notetype.tokens:
             if skip != '' and (token.type != 'ENDIF' or token.value != skip):
                 continue
 
             if token.type == 'STARTIF':
-                if self.__fetch_field(token.value) == '':
+                text = self.other_note.fields[self.notetype.fields[token.value]]
+                refs |= self.__references(text)
+                if text == '':
                     skip = token.value
             elif token.type == 'ENDIF':
                 skip = ''
-            elif token.type == 'FIELD_NORMAL':
-                out += self.__fetch_field(token.value)
-            elif token.type == 'FIELD_CLOZE':
-                out += self.__fetch_cloze_field(token.value)
-            elif token.type == 'FIELD_CLOZE_OVERLAPPING':
-                out += self.__fetch_cloze_overlapping_field(token.value)
-            elif token.type == 'FIELD_ASSUMPTIONS':
-                out += self.__fetch_assumptions_field(token.value)
-            elif token.type == 'FIELD_IM_EQ_HINT':
-                out += self.__fetch_im_eq_hint_field(token.value)
-            elif token.type == 'TEXT':
-                out += token.value
-
-        return BeautifulSoup(out, 'html.parser')
+            else:
+                tokens.append(token)
 
+        field_tokens = [token for token in tokens if token.type in self.STRIP]
+        texts = self.__strip([(token.value, self.STRIP[token.type]) for token in field_tokens])
+        fields = dict(zip(field_tokens, texts))
+        for text in texts:
+            refs |= self.__references(text)
 
-def sync_field(col: Collection, this_note: Note, field_idx: int) -> bool:
+        out = '\n'
+        for token in tokens:
+            out += token.value if token.type == 'TEXT' else fields[token]
+        return out, refs
+
+    def __render_fields(self) -> tuple[str, frozenset[str]]:
+        # Fields are stripped the same way as in the note type template
+        flags = self.notetype.strip
+        texts = self.__strip([(field, flags.get(field, Strip.NONE)) for field in self.fields])
+
+        refs = frozenset()
+        out = '\n'
+        for text in texts:
+            refs |= self.__references(text)
+            out += f'<div>{text}</div>\n'
+        return out, refs
+
+    def stamp(self) -> str:
+        '''
+        Digest of everything the rendered block depends on: the note type
+        template and fields, the selected fields and the source note's fields
+        read by the template or selected.
+        '''
+        digest = hashlib.blake2b(self.notetype.digest, digest_size=8)
+        digest.update(repr(self.fields).encode())
+        read = self.notetype.read if self.fields is None else (self.notetype.fields[name] for name in self.fields)
+        for idx in read:
+            digest.update(self.other_note.fields[idx].encode())
+            digest.update(SEPARATOR.encode())
+        return digest.hexdigest()
+
+    def block_stamp(self, contents: str) -> str:
+        '''
+        Stamp attribute of a block rendered into this note: its inputs, see
+        stamp(), the note and the serialized contents of the block, so that
+        blocks edited by hand are rendered again.
+        '''
+        digest = hashlib.blake2b(self.stamp().encode(), digest_size=8)
+        digest.update(str(self.this_note.id).encode())
+        digest.update(SEPARATOR.encode())
+        digest.update(contents.encode())
+        return digest.hexdigest()
+
+    def fetch_html(self) -> str:
+        '''
+        Return the rendered block serialized exactly as it is written into the span.
+        '''
+        # Shared with syncs running in the background, the cache may be cleared at any time
+        key = (self.notetype.digest, self.fields, tuple(self.other_note.fields))
+        cached = self.render_cache.get(key)
+        if cached is None:
+            if len(self.render_cache) >= self.RENDER_CACHE_SIZE:
+                self.render_cache.clear()
+            stamp = self.stamp() if store is not None else ''
+            cached = store.get(stamp) if store is not None else None
+            if cached is None:
+                if self.fields is None:
+                    out, refs = self.__render_template()
+                else:
+                    out, refs = self.__render_fields()
+                # Parsed once per distinct rendering, cached blocks are never parsed again
+                cached = (markup.serialize(markup.parse(out)), refs)
+                if store is not None:
+                    store.put(stamp, *cached)
+            self.render_cache[key] = cached
+
+        html, refs = cached
+        if str(self.this_note.id) in refs:
+            raise ValueError('Cycle detected')
+        return html
+
+    def fetch(self) -> BeautifulSoup:
+        return markup.parse(self.fetch_html())
+
+
+class NotetypeInfo(NamedTuple):
+    name: str
+    fields: dict[str, int]  # field name -> index
+    tokens: list[Fetcher.Token] | None  # None if the note type has no template
+    strip: dict[str, Strip]  # transform the template applies to a field
+    read: tuple[int, ...]  # indices of the fields the template reads
+    digest: bytes  # changes whenever anything above changes
+
+
+_notetypes: dict[str, dict[NotetypeId, NotetypeInfo]] = {}
+
+
+def notetype_info(note: Note) -> NotetypeInfo:
+    '''
+    Return metadata of the note type of the note, cached per collection and model id.
+    '''
+    return load_notetype(note.col, note.mid)
+
+
+def load_notetype(col: Collection, mid: NotetypeId) -> NotetypeInfo:
+    cache = _notetypes.setdefault(col.path, {})
+    info = cache.get(mid)
+    if info is None:
+        notetype = col.models.get(mid)
+        tokens = Fetcher.load_template(notetype['name'])
+        strip = {}
+        for token in tokens or ():
+            if token.type in Fetcher.STRIP:
+                strip.setdefault(token.value, Fetcher.STRIP[token.type])
+        fields = {field['name']: field['ord'] for field in notetype['flds']}
+        read = tuple(sorted({fields[token.value] for token in tokens or ()
+                             if token.type != 'TEXT' and token.value in fields}))
+        digest = hashlib.blake2b(repr((notetype['name'], fields, tokens, strip)).encode()).digest()
+        info = cache[mid] = NotetypeInfo(notetype['name'], fields, tokens, strip, read, digest)
+    return info
+
+
+def preload_notetypes(col: Collection):
+    '''
+    Load templates and metadata of all note types ahead of the first sync.
+    '''
+    for notetype in col.models.all_names_and_ids():
+        load_notetype(col, NotetypeId(notetype.id))
+
+
+def invalidate_notetypes(col: Collection):
+    '''
+    Note types of the collection changed, drop their cached metadata.
+    '''
+    _notetypes.pop(col.path, None)
+
+
+def is_fresh(fetcher: Fetcher, span: Tag) -> bool:
+    '''
+    Whether a top level unidir span carries the stamp of its current source and
+    its current contents, so rendering would not change it.
+    '''
+    stamp = span.get('stamp')
+    return stamp is not None and stamp == fetcher.block_stamp(span.decode_contents(formatter='html5'))
+
+
+def render_field(col: Collection, this_note: Note, field_idx: int,
+                 sources: Mapping[NoteId, Note] | None = None) -> bool:
+    '''
+    Render unidir spans of the field in memory, the note is not saved. Source
+    notes found in sources are rendered as they are there, e.g. changed in
+    memory by a batch, others are read from the collection.
+    '''
     # - find span with class 'sync' with 'note' attribute
     # - fetch optional 'fields' attribute (can contain special fields: text)
     # - or use defaults depending on the target note type)
@@ -187,62 +335,136 @@ def sync_field(col: Collection, this_note: Note, field_idx: int) -> bool:
     #   - Algos: copy text, input, and output
     # - strip {{c1::}} and [[oc1::]]
 
-    # TODO: support selection of fields to sync
-    # multi_valued_attributes={'*': ['class', 'fields']}
-
-    if this_note.id == 0:
-        return False  # the card is being created
     if field_idx < 0 or field_idx >= len(this_note.values()):
         return False  # should not happen
 
-    changed = False
-    bs = BeautifulSoup(this_note.values()[field_idx], 'html.parser')
+    text = this_note.values()[field_idx]
+    if 'sync' not in text:
+        return False
+    sync_spans = markup.SyncSpans(text)
+    replacements = []
 
-    # recursive=False: transitive references are not propagated (only top spans are synced)
-    spans = bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False)
-    for span in spans:
+    # Only top spans are synced, transitive references are not propagated
+    for span in sync_spans.spans:
         other_id = span.get('note')
         if other_id is None:
             continue
 
-        span_new = copy(span)
-        span_new.clear()
+        attrs = dict(span.attrs)
+        # Set again below only for blocks rendered with stamps enabled
+        attrs.pop('stamp', None)
         try:
-            other_note = col.get_note(int(other_id))
-            # other_fields = span.get('fields')
-            bs_new = Fetcher(this_note, other_note).fetch()
-            span_new.append(bs_new)
+            other_nid = NoteId(int(other_id))
+            if sources is not None and other_nid in sources:
+                other_note = sources[other_nid]
+            else:
+                other_note = col.get_note(other_nid)
+            fetcher = Fetcher(this_note, other_note, span.get('fields'))
+            if use_stamps and is_fresh(fetcher, span):
+                continue
+            html = fetcher.fetch_html()
+            if use_stamps:
+                attrs['stamp'] = fetcher.block_stamp(html)
         except (ValueError, anki.errors.NotFoundError) as e:
-            div = bs.new_tag('div')
-            if str(e) in {'Unknown model', 'Cycle detected'}:
-                div.string = str(e)
+            if str(e) in {'Unknown model', 'Unknown field', 'Cycle detected'}:
+                html = f'<div>{e}</div>'
             else:
-                div.string = 'Invalid note ID'
-            span_new.append(div)
+                html = '<div>Invalid note ID</div>'
+
+        # Blocks without a stamp are not rewritten just to add one, but a stale
+        # stamp is replaced, otherwise the block would be rendered on every pass
+        stale = use_stamps and span.has_attr('stamp') and span['stamp'] != attrs.get('stamp')
+        if stale or span.decode_contents(formatter='html5') != html:
+            replacements.append((span, markup.element_html('span', attrs, html)))
+
+    if len(replacements) == 0:
+        return False
+    # Only the span regions are rewritten, the note is updated only if its bytes changed
+    text_new = sync_spans.replace(replacements)
+    if text_new == text:
+        return False
+    this_note.values()[field_idx] = text_new
+    return True
+
+
+def render_note(col: Collection, note: Note, sources: Mapping[NoteId, Note] | None = None) -> bool:
+    changed = False
+    for field_idx in range(len(note.fields)):
+        changed |= render_field(col, note, field_idx, sources)
+    return changed
 
-        if span != span_new:
-            span.replace_with(span_new)
-            changed = True
 
+def sync_field(col: Collection, this_note: Note, field_idx: int) -> bool:
+    if this_note.id == 0:
+        return False  # the card is being created
+    changed = render_field(col, this_note, field_idx)
     if changed:
-        this_note.values()[field_idx] = bs.encode(formatter='html5').decode('utf-8')
         col.update_note(this_note)
     return changed
 
 
 def sync_note(col: Collection, note: Note) -> bool:
-    changed = False
-    for field in note.keys():
-        changed |= sync_field(col, note, note._field_index(field))
+    if note.id == 0:
+        return False  # the card is being created
+    changed = render_note(col, note)
+    if changed:
+        col.update_note(note)
     return changed
 
 
-def sync_all(col: Collection) -> int:
-    n_changed = 0
-    ids = col.find_notes('"*:*<span class=\\"sync\\" note=*"')
-    for note_id in ids:
-        note = col.get_note(note_id)
-        changed = sync_note(col, note)
-        if changed:
-            n_changed += 1
+def open_store(path: str, max_entries: int):
+    '''
+    Persist rendered blocks in the SQLite database at path, or stop persisting them if max_entries is 0.
+    '''
+    global store
+    if store is not None and store.path == path:
+        store.max_entries = max_entries
+        if max_entries > 0:
+            return
+    close_store()
+    if max_entries > 0:
+        store = RenderStore(path, max_entries, RENDER_VERSION)
+
+
+def flush_store():
+    if store is not None:
+        store.flush()
+
+
+def close_store():
+    global store
+    if store is not None:
+        store.close()
+        store = None
+
+
+# Fields with unidir spans. A regular expression, wildcards do not match rendered blocks spanning several lines.
+# Rendered spans have their attributes sorted, the note may follow other attributes.
+SYNC_SEARCH = '"*:re:<span class=\\"sync\\"[^>]*\\snote="'
+
+
+def scope_search(col: Collection, search: str = '', decks: Sequence[str] = (),
+                 notetypes: Sequence[str] = ()) -> str:
+    '''
+    Return a search for the notes matching the search, in any of the decks
+    (including their subdecks) and of any of the note types. Empty parts do not restrict the scope.
+    '''
+    parts = [search] if search.strip() != '' else []
+    if len(decks) > 0:
+        parts.append(col.group_searches(*(SearchNode(deck=deck) for deck in decks), joiner='OR'))
+    if len(notetypes) > 0:
+        parts.append(col.group_searches(*(SearchNode(note=name) for name in notetypes), joiner='OR'))
+    return col.build_search_string(*parts) if len(parts) > 0 else ''
+
+
+def sync_all(col: Collection, search: str = '', decks: Sequence[str] = (), notetypes: Sequence[str] = ()) -> int:
+    '''
+    Render unidir spans of all notes in the scope, see scope_search. Raises
+    anki.errors.SearchError for an invalid search.
+    '''
+    scope = scope_search(col, search, decks, notetypes)
+    ids = col.find_notes(SYNC_SEARCH if scope == '' else col.build_search_string(scope, SYNC_SEARCH))
+    # Notes edited while the collection is rendered are rendered again, see cas.update
+    n_changed = len(cas.update(col, ids, render_note))
+    flush_store()
     return n_changed